@@ -0,0 +1,204 @@
+from concurrent.futures import ThreadPoolExecutor
+import os.path as path
+import threading
+import tempfile
+import queue
+import json
+import os
+
+# Number of directory levels between the ADNI folder and the nifti files:
+# ADNI/<subject>/<description>/<date>/<image>/*.nii.gz
+SCAN_DEPTH = 4
+
+
+def loadcache(cache_file):
+    """
+    Read the directory cache from a previous discovery
+    :param cache_file: json filename, can be None
+    :return: dictionary mapping directories to their mtime and content
+    """
+    if cache_file is None or not path.exists(cache_file):
+        return dict()
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except ValueError:
+        print('Ignoring corrupted discovery cache ' + cache_file)
+        return dict()
+
+
+def savecache(cache_file, cache):
+    """
+    Write the directory cache, replacing the previous one atomically. The
+    temporary file is unique to each call so that concurrent writers cannot
+    interleave, but the last one still wins: processes discovering
+    different subjects (--shard) should each use their own cache file.
+    :param cache_file: json filename
+    :param cache: dictionary mapping directories to their mtime and content
+    """
+    fd, tmp_file = tempfile.mkstemp(
+        dir=path.dirname(path.abspath(cache_file)),
+        prefix=path.basename(cache_file) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_file, cache_file)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+
+
+def listdirectory(directory, old_cache, new_cache, suffixes):
+    """
+    List the sub-directories and matching files of a directory, using the
+    cached listing if the directory has not been modified since
+    :param directory: directory to list
+    :param old_cache: dictionary from the previous discovery
+    :param new_cache: dictionary updated with the current listing
+    :param suffixes: tuple of file suffixes to keep
+    :return: tuple containing the lists of sub-directories and files names
+    """
+    mtime = os.stat(directory).st_mtime_ns
+    cached = old_cache.get(directory)
+    if cached is not None and cached['mtime'] == mtime:
+        new_cache[directory] = cached
+        return cached['dirs'], cached['files']
+    dirs = []
+    files = []
+    with os.scandir(directory) as it:
+        for entry in it:
+            # glob ignores hidden files, do the same
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir():
+                dirs.append(entry.name)
+            elif entry.name.endswith(suffixes):
+                files.append(entry.name)
+    new_cache[directory] = {'mtime': mtime, 'dirs': dirs, 'files': files}
+    return dirs, files
+
+
+def walksubject(subject_dir, old_cache, new_cache, suffixes, found,
+                stop=None):
+    """
+    Walk a subject folder and push every scan file found in a queue
+    :param subject_dir: ADNI/<subject> directory
+    :param old_cache: dictionary from the previous discovery
+    :param new_cache: dictionary updated with the current listing
+    :param suffixes: tuple of file suffixes to keep
+    :param found: queue receiving the scan filenames
+    :param stop: threading.Event set when the walk should be abandoned
+    """
+    stack = [(subject_dir, 1)]
+    while len(stack) > 0:
+        if stop is not None and stop.is_set():
+            return
+        directory, depth = stack.pop()
+        dirs, files = listdirectory(directory, old_cache, new_cache, suffixes)
+        if depth == SCAN_DEPTH:
+            for f in files:
+                found.put(path.join(directory, f))
+        else:
+            for d in dirs:
+                stack.append((path.join(directory, d), depth + 1))
+
+
+def discoverscans(input_path, cache_file=None, workers=8,
+                  suffixes=('.nii.gz',), select=None):
+    """
+    Find the nifti files of an ADNI folder, equivalent to globbing
+    ADNI/*/*/*/*/*.nii.gz. Subject folders are walked in parallel and the
+    files are yielded as soon as they are found, in no particular order.
+    When a cache file is provided, directories whose mtime did not change
+    since the previous run are not listed again.
+    :param input_path: path to the folder containing the ADNI data
+    :param cache_file: json file storing the directory mtimes, can be None
+    :param workers: number of subject folders walked concurrently
+    :param suffixes: tuple of file suffixes to keep
+    :param select: function called with each subject folder name and
+    returning whether it is walked, None to walk all of them
+    :return: generator of nifti filenames
+    """
+    adni_dir = path.join(input_path, 'ADNI')
+    if not path.isdir(adni_dir):
+        return
+    old_cache = loadcache(cache_file)
+    # Cached listings only contain the files with the requested suffixes
+    if old_cache.get('suffixes') != list(suffixes):
+        old_cache = dict()
+    new_cache = {'suffixes': list(suffixes)}
+    subject_dirs, _ = listdirectory(adni_dir, old_cache, new_cache, ())
+    if select is not None:
+        ignored = set(d for d in subject_dirs if not select(d))
+        subject_dirs = [d for d in subject_dirs if d not in ignored]
+        # Keep the cached listings of the subjects that are not walked
+        for directory in old_cache:
+            if directory == 'suffixes':
+                continue
+            relative = path.relpath(directory, adni_dir).split(os.sep)[0]
+            if relative in ignored:
+                new_cache[directory] = old_cache[directory]
+
+    found = queue.Queue()
+    done = object()
+    lock = threading.Lock()
+    stop = threading.Event()
+    remaining = [len(subject_dirs)]
+
+    def work(subject_dir):
+        # Each worker fills its own cache to avoid sharing a dictionary
+        subject_cache = dict()
+        try:
+            walksubject(subject_dir, old_cache, subject_cache, suffixes,
+                        found, stop)
+        finally:
+            with lock:
+                new_cache.update(subject_cache)
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    found.put(done)
+
+    if len(subject_dirs) == 0:
+        found.put(done)
+    pool = ThreadPoolExecutor(max_workers=workers)
+    finished = False
+    try:
+        futures = [pool.submit(work, path.join(adni_dir, d))
+                   for d in subject_dirs]
+        while True:
+            scan_file = found.get()
+            if scan_file is done:
+                break
+            yield scan_file
+        # Raise any error encountered while walking a subject
+        for f in futures:
+            f.result()
+        finished = True
+    finally:
+        if not finished:
+            # The caller stopped consuming, e.g. after an error or Ctrl-C:
+            # abandon the remaining walks instead of waiting for them
+            stop.set()
+        pool.shutdown(wait=finished, cancel_futures=not finished)
+
+    if cache_file is not None:
+        savecache(cache_file, new_cache)
+
+
+def findscaninfofiles(input_path):
+    """
+    Index the xml files stored in the ADNI folder by image identifier, so
+    that they don't have to be globbed for every scan
+    :param input_path: path to the folder containing the ADNI data
+    :return: dictionary mapping image identifiers to lists of xml filenames
+    """
+    scan_info_files = dict()
+    adni_dir = path.join(input_path, 'ADNI')
+    with os.scandir(adni_dir) as it:
+        for entry in it:
+            if entry.name.startswith('.') or \
+                    not entry.name.endswith('.xml') or not entry.is_file():
+                continue
+            scan_id = entry.name.removesuffix('.xml').split('_')[-1]
+            scan_info_files.setdefault(scan_id, []).append(entry.path)
+    return scan_info_files
@@ -0,0 +1,302 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os.path as path
+import tracemalloc
+import argparse
+import tempfile
+import resource
+import shutil
+import glob
+import json
+import time
+import sys
+
+from generate_fake_adni import writedataset
+
+PHASES = ['glob', 'discovery', 'scan info', 'mid-planes', 'snapshot']
+
+
+def listscans(input_path, sample=None):
+    """
+    :param input_path: path to the folder containing the ADNI folder
+    :param sample: only return the first scans, None for all of them
+    :return: sorted list of nifti filenames
+    """
+    from adni_discovery import discoverscans
+    scans = sorted(discoverscans(input_path))
+    return scans if sample is None else scans[:sample]
+
+
+def preparephase(phase, input_path, sample):
+    """
+    Prepare the input of a phase, this part is not measured and runs in the
+    main process so that it does not count in the peak memory of the phase
+    :param phase: name of the phase
+    :param input_path: path to the folder containing the ADNI folder
+    :param sample: number of scans rendered by the snapshot phases
+    :return: input of runphase
+    """
+    from adni_discovery import findscaninfofiles
+    from upload_adni_data import getscanid, getscaninfofile
+    if phase == 'scan info':
+        scan_info_files = findscaninfofiles(input_path)
+        return [getscaninfofile(scan_info_files, getscanid(s))
+                for s in listscans(input_path)]
+    if phase in ['mid-planes', 'snapshot']:
+        return listscans(input_path, sample)
+    return None
+
+
+def runphase(phase, input_path, items, output_path, workers):
+    """
+    Run a phase
+    :param phase: name of the phase
+    :param input_path: path to the folder containing the ADNI folder
+    :param items: list returned by preparephase
+    :param output_path: folder where snapshots are written
+    :param workers: number of discovery threads
+    :return: number of items processed
+    """
+    if phase == 'glob':
+        scans = glob.glob(path.join(input_path, 'ADNI', '*', '*', '*', '*',
+                                    '*.nii.gz'))
+        glob.glob(path.join(input_path, 'ADNI', '*.xml'))
+        return len(scans)
+    if phase == 'discovery':
+        from adni_discovery import discoverscans, findscaninfofiles
+        scans = list(discoverscans(input_path, workers=workers))
+        findscaninfofiles(input_path)
+        return len(scans)
+    if phase == 'scan info':
+        from upload_adni_data import getscaninfo
+        for scan_info_file in items:
+            getscaninfo(scan_info_file)
+        return len(items)
+    if phase == 'mid-planes':
+        from nifti_index import readmidplanes, scaleplanes
+        for scan_file in items:
+            scaleplanes(readmidplanes(scan_file))
+        return len(items)
+    if phase == 'snapshot':
+        from nifti_index import rendersnapshot
+        for n, scan_file in enumerate(items):
+            rendersnapshot(scan_file,
+                           path.join(output_path, '{}.png'.format(n)))
+        return len(items)
+    raise ValueError('Unknown phase ' + phase)
+
+
+def getmaxrss():
+    """
+    :return: peak resident memory of the current process in bytes
+    """
+    # ru_maxrss is in kilobytes on linux and in bytes on macos
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        maxrss *= 1024
+    return maxrss
+
+
+def measurephase(phase, input_path, items, workers, trace):
+    """
+    Measure the time and peak memory of a phase. It is meant to run in a
+    fresh process, receiving its prepared input, so that the peak resident
+    memory only covers the interpreter, the input and this phase.
+    :param phase: name of the phase
+    :param input_path: path to the folder containing the ADNI folder
+    :param items: list returned by preparephase
+    :param workers: number of discovery threads
+    :param trace: record the peak of python allocations with tracemalloc,
+    which slows down the phase
+    :return: dictionary containing the number of items, the time in
+    seconds, the peak of python allocations, the peak resident memory
+    before the phase and the peak resident memory in bytes, or the error
+    message if the phase failed
+    """
+    output_path = tempfile.mkdtemp()
+    try:
+        startrss = getmaxrss()
+        if trace:
+            tracemalloc.start()
+        start = time.perf_counter()
+        count = runphase(phase, input_path, items, output_path, workers)
+        elapsed = time.perf_counter() - start
+        traced_peak = tracemalloc.get_traced_memory()[1] if trace else None
+    except Exception as e:
+        return {'error': '{}: {}'.format(type(e).__name__, e)}
+    finally:
+        tracemalloc.stop()
+        shutil.rmtree(output_path)
+    return {'items': count, 'time': elapsed, 'traced_peak': traced_peak,
+            'startrss': startrss, 'maxrss': getmaxrss()}
+
+
+def inprocess(*args):
+    """
+    Run measurephase in a new process
+    """
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(measurephase, *args).result()
+
+
+def getdataset(work_path, scans, parameters):
+    """
+    Generate a fake ADNI folder, or reuse the one generated by a previous
+    run with the same parameters
+    :param work_path: folder containing the datasets
+    :param scans: number of scans
+    :param parameters: dictionary of writedataset arguments
+    :return: path to the folder containing the ADNI folder
+    """
+    input_path = path.join(work_path, 'fake_adni_{}'.format(scans))
+    info_file = path.join(input_path, 'fake_adni.json')
+    if path.exists(info_file):
+        with open(info_file) as f:
+            dataset = json.load(f)
+        if all(dataset.get(k) == v for k, v in parameters.items()) and \
+                dataset['scans'] == scans:
+            return input_path
+        shutil.rmtree(input_path)
+    start = time.time()
+    writedataset(input_path, scans, verbose=False, **parameters)
+    print('Generated {} scans in {:.1f} second(s)'.format(
+        scans, time.time() - start))
+    return input_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measure the time and peak memory of the local phases '
+                    'of upload_adni_data.py (discovery, xml parsing, '
+                    'snapshot rendering) on fake ADNI folders of '
+                    'increasing size')
+    parser.add_argument('-s', '--sizes',
+                        help='Number of scans of each fake ADNI folder',
+                        type=int,
+                        nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('-p', '--phases',
+                        help='Phases to measure',
+                        choices=PHASES,
+                        nargs='+',
+                        default=PHASES)
+    parser.add_argument('-w', '--work-path',
+                        help='Folder where the fake ADNI folders are '
+                             'generated and kept for the next runs, a '
+                             'temporary folder is used by default',
+                        type=str)
+    parser.add_argument('--sample',
+                        help='Number of scans rendered by the snapshot '
+                             'phases',
+                        type=int,
+                        default=100)
+    parser.add_argument('--shape',
+                        help='Number of voxels along each axis of the fake '
+                             'images',
+                        type=int,
+                        nargs=3,
+                        default=[32, 32, 24])
+    parser.add_argument('--orientation',
+                        help='Orientation codes of the fake images',
+                        type=str,
+                        nargs='+',
+                        default=['LAS', 'random'])
+    parser.add_argument('--flush-spacing',
+                        help='Uncompressed bytes between gzip flush points '
+                             'of the fake images, 0 for plain gzip files',
+                        type=int,
+                        default=0)
+    parser.add_argument('--discovery-workers',
+                        help='Number of threads walking the subject folders',
+                        type=int,
+                        default=8)
+    parser.add_argument('--no-tracemalloc',
+                        help='Do not measure the peak of python allocations',
+                        action='store_true')
+    parser.add_argument('-o', '--output',
+                        help='Save the results in this json file',
+                        type=str)
+    parser.add_argument('-b', '--baseline',
+                        help='Json file of a previous run, the script fails '
+                             'if a phase is slower than the baseline times '
+                             'the tolerance, fails or is not measured',
+                        type=str)
+    parser.add_argument('--tolerance',
+                        help='Allowed slowdown factor compared to the '
+                             'baseline',
+                        type=float,
+                        default=1.25)
+    args = parser.parse_args()
+
+    work_path = args.work_path or tempfile.mkdtemp()
+    parameters = {'shape': args.shape,
+                  'orientations': args.orientation,
+                  'flush_spacing': args.flush_spacing}
+
+    results = dict()
+    previous = dict()
+    print('{:>7s} {:11s} {:>7s} {:>9s} {:>9s} {:>8s} {:>10s} {:>9s} '
+          '{:>9s}'.format('scans', 'phase', 'items', 'time', 'per item',
+                          'scaling', 'py peak', 'start rss', 'max rss'))
+    try:
+        for size in sorted(args.sizes):
+            input_path = getdataset(work_path, size, parameters)
+            for phase in args.phases:
+                items = preparephase(phase, input_path, args.sample)
+                result = inprocess(phase, input_path, items,
+                                   args.discovery_workers, False)
+                if 'error' not in result and not args.no_tracemalloc:
+                    traced = inprocess(phase, input_path, items,
+                                       args.discovery_workers, True)
+                    result['traced_peak'] = traced.get('traced_peak')
+                results['{} {}'.format(size, phase)] = result
+                if 'error' in result:
+                    print('{:7d} {:11s} failed: {}'.format(
+                        size, phase, result['error']))
+                    continue
+
+                per_item = result['time'] / max(1, result['items'])
+                # Growth of the time per item compared to the previous
+                # size, 1 when the phase scales linearly
+                scaling = ''
+                if phase in previous:
+                    scaling = '{:.2f}'.format(per_item / previous[phase]
+                                              if previous[phase] > 0 else 0.)
+                previous[phase] = per_item
+                traced_peak = '' if result['traced_peak'] is None else \
+                    '{:.1f}MB'.format(result['traced_peak'] / 1e6)
+                print('{:7d} {:11s} {:7d} {:8.3f}s {:7.3f}ms {:>8s} {:>10s} '
+                      '{:7.1f}MB {:7.1f}MB'.format(
+                          size, phase, result['items'], result['time'],
+                          per_item * 1e3, scaling, traced_peak,
+                          result['startrss'] / 1e6, result['maxrss'] / 1e6))
+    finally:
+        if args.work_path is None:
+            shutil.rmtree(work_path)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        # Phases of the baseline that now fail or were not measured
+        failures = [n for n in baseline
+                    if 'time' in baseline[n] and
+                    'time' not in results.get(n, {})]
+        regressions = [n for n in results
+                       if 'time' in results[n] and
+                       'time' in baseline.get(n, {}) and
+                       results[n]['time'] > baseline[n]['time'] *
+                       args.tolerance]
+        for n in failures:
+            print('Regression: {} {}, baseline {:.3f}s'.format(
+                n, 'failed' if n in results else 'was not measured',
+                baseline[n]['time']))
+        for n in regressions:
+            print('Regression: {} took {:.3f}s, baseline {:.3f}s'.format(
+                n, results[n]['time'], baseline[n]['time']))
+        if len(failures) > 0 or len(regressions) > 0:
+            sys.exit(1)
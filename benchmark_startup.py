@@ -0,0 +1,212 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os.path as path
+import subprocess
+import statistics
+import threading
+import tempfile
+import argparse
+import shutil
+import json
+import time
+import sys
+import os
+
+HERE = path.dirname(path.abspath(__file__))
+
+# Snippet displaying the login window of the viewer and printing the time
+# at which it is shown
+VIEWER_SNIPPET = """
+import time, sys
+sys.path.insert(0, {here!r})
+from PyQt5 import QtWidgets
+import view_snapshot_gui
+app = QtWidgets.QApplication(sys.argv)
+login = view_snapshot_gui.XNATLogin()
+login.show()
+app.processEvents()
+print(time.time())
+"""
+
+
+class FirstRequestServer(ThreadingHTTPServer):
+    """
+    Local HTTP server recording the time of the first request it receives
+    """
+    def __init__(self):
+        super(FirstRequestServer, self).__init__(('127.0.0.1', 0),
+                                                 FirstRequestHandler)
+        self.first_request = threading.Event()
+        self.first_request_time = None
+
+    def url(self):
+        """
+        :return: url of the server
+        """
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+
+class FirstRequestHandler(BaseHTTPRequestHandler):
+    """
+    Answer every request with an empty json document
+    """
+    def answer(self):
+        if not self.server.first_request.is_set():
+            self.server.first_request_time = time.time()
+            self.server.first_request.set()
+        body = b'{}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_PUT = do_POST = do_DELETE = answer
+
+    def log_message(self, *args):
+        pass
+
+
+def timefirstrequest(command, timeout):
+    """
+    Start a script and measure how long it takes to send its first request
+    :param command: list containing the command, where the '{url}' item is
+    replaced by the url of the local server
+    :param timeout: maximum time to wait in seconds
+    :return: time to first request in seconds, None on timeout
+    """
+    server = FirstRequestServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    command = [c.replace('{url}', server.url()) for c in command]
+    start = time.time()
+    process = subprocess.Popen(command, cwd=HERE,
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    # Stop waiting early if the script fails before sending anything
+    received = False
+    while not received and process.poll() is None and \
+            time.time() - start < timeout:
+        received = server.first_request.wait(0.01)
+    received = server.first_request.is_set()
+    process.kill()
+    process.wait()
+    server.shutdown()
+    server.server_close()
+    if not received:
+        return None
+    return server.first_request_time - start
+
+
+def timefirstwindow(timeout):
+    """
+    Measure how long the viewer takes to display its login window
+    :param timeout: maximum time to wait in seconds
+    :return: time to first window in seconds, None on failure
+    """
+    env = dict(os.environ)
+    env.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    start = time.time()
+    try:
+        output = subprocess.run(
+            [sys.executable, '-c', VIEWER_SNIPPET.format(here=HERE)],
+            cwd=HERE, env=env, capture_output=True, text=True,
+            timeout=timeout)
+        return float(output.stdout.strip().splitlines()[-1]) - start
+    except (subprocess.TimeoutExpired, ValueError, IndexError):
+        return None
+
+
+def timeimport(module, timeout):
+    """
+    Measure the time taken by a fresh interpreter to import a module
+    :param module: module name
+    :param timeout: maximum time to wait in seconds
+    :return: import time in seconds, None on failure
+    """
+    start = time.time()
+    result = subprocess.run([sys.executable, '-c', 'import ' + module],
+                            cwd=HERE, capture_output=True, timeout=timeout)
+    if result.returncode != 0:
+        return None
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measure the time to first request of the command line '
+                    'scripts and the time to first window of the viewer')
+    parser.add_argument('-r', '--repeat',
+                        help='Number of runs per measurement, the median '
+                             'is reported',
+                        type=int,
+                        default=5)
+    parser.add_argument('-t', '--timeout',
+                        help='Maximum time to wait for each run in seconds',
+                        type=float,
+                        default=60.)
+    parser.add_argument('-o', '--output',
+                        help='Save the results in this json file',
+                        type=str)
+    parser.add_argument('-b', '--baseline',
+                        help='Json file of a previous run, the script fails '
+                             'if a measurement is slower than the baseline '
+                             'times the tolerance',
+                        type=str)
+    parser.add_argument('--tolerance',
+                        help='Allowed slowdown factor compared to the '
+                             'baseline',
+                        type=float,
+                        default=1.25)
+    args = parser.parse_args()
+
+    input_path = tempfile.mkdtemp()
+    plan_file = path.join(input_path, 'plan.json')
+    measurements = {
+        'upload_adni_data first request': lambda: timefirstrequest(
+            [sys.executable, 'upload_adni_data.py', '{url}', 'user', 'pwd',
+             input_path, '--plan', plan_file], args.timeout),
+        'extract_scanners_info first request': lambda: timefirstrequest(
+            [sys.executable, 'extract_scanners_info.py', '{url}', 'user',
+             'pwd'], args.timeout),
+        'view_snapshot_gui first window': lambda: timefirstwindow(
+            args.timeout),
+    }
+    for module in ['upload_adni_data', 'extract_scanners_info',
+                   'view_snapshot_gui', 'xnat_mirror']:
+        measurements[module + ' import'] = \
+            lambda m=module: timeimport(m, args.timeout)
+
+    results = dict()
+    for name, measure in measurements.items():
+        times = [measure() for _ in range(args.repeat)]
+        times = [t for t in times if t is not None]
+        results[name] = statistics.median(times) if len(times) > 0 else None
+        if results[name] is None:
+            print('{:40s} failed'.format(name))
+        else:
+            print('{:40s} {:.3f}s'.format(name, results[name]))
+    shutil.rmtree(input_path)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        # A measurement that worked in the baseline but now fails, e.g. a
+        # script that no longer reaches its first request, is a regression
+        failures = [n for n in baseline
+                    if baseline[n] is not None and results.get(n) is None]
+        regressions = [n for n in results
+                       if results[n] is not None and
+                       baseline.get(n) is not None and
+                       results[n] > baseline[n] * args.tolerance]
+        for n in failures:
+            print('Regression: {} failed, baseline {:.3f}s'.format(
+                n, baseline[n]))
+        for n in regressions:
+            print('Regression: {} took {:.3f}s, baseline {:.3f}s'.format(
+                n, results[n], baseline[n]))
+        if len(failures) > 0 or len(regressions) > 0:
+            sys.exit(1)
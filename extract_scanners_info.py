@@ -1,10 +1,24 @@
-import pyxnat as xnat
-import pandas as pd
+# pyxnat and pandas are imported when querying XNAT, so that reading a
+# local mirror starts quickly
+from concurrent.futures import ProcessPoolExecutor
+from xnat_mirror import openmirror, getsessions
+from adni_discovery import findscaninfofiles
+import xml.etree.ElementTree as ET
 import argparse
-import requests
-import urllib3
+import csv
+import sys
+import os
 
-urllib3.disable_warnings()
+# Elements of the ADNI xml files used by the offline report, identified by
+# their tag or by the value of their term attribute
+SIDECAR_TAGS = {'siteKey': 'site',
+                'subjectIdentifier': 'subject_id',
+                'seriesIdentifier': 'session_id',
+                'dateAcquired': 'date',
+                'visitIdentifier': 'type'}
+SIDECAR_TERMS = {'Manufacturer': 'manufacturer',
+                 'Mfg Model': 'model',
+                 'Field Strength': 'field_strength'}
 
 
 def getinterface(url, user, passwd):
@@ -16,6 +30,9 @@ def getinterface(url, user, passwd):
     :param passwd: xnat password as a string
     "return: pyxnat interface object
     """
+    import pyxnat as xnat
+    import urllib3
+    urllib3.disable_warnings()
     # Remove the last '/' to avoid requests issue
     if url.endswith('/'):
         url = url[:-1]
@@ -28,62 +45,113 @@ def getinterface(url, user, passwd):
         intf._exec('/data/JSESSION', method='DELETE')
     except:
         raise ValueError('Unable to connect to XNAT')
-    else:
-        try:
-            intf.manage.schemas.add('schemas/xnat.xsd')
-        except:
-            raise ValueError('Unable to download XNAT schema')
     return intf
 
 
-if __name__ == '__main__':
-    # Parser to set default values for xnat url and credentials
-    parser = argparse.ArgumentParser()
-    parser.add_argument('xnat_url',
-                        help='Default XNAT instance URL',
-                        type=str)
-    parser.add_argument('xnat_user',
-                        help='Default XNAT username',
-                        type=str)
-    parser.add_argument('xnat_pwd',
-                        help='Default XNAT password',
-                        type=str)
-    parser.add_argument('-p', '--project',
-                        help='XNAT project where the data will be uploaded',
-                        type=str,
-                        default='ADNI')
-    requests.session().close()
-    args = parser.parse_args()
+def loadschema(intf):
+    """
+    Download the XNAT schema the first time it is needed rather than when
+    connecting
+    :param intf: pyxnat interface object
+    """
+    if getattr(intf, 'schema_loaded', False):
+        return
+    try:
+        intf.manage.schemas.add('schemas/xnat.xsd')
+    except:
+        raise ValueError('Unable to download XNAT schema')
+    intf.schema_loaded = True
 
-    # # Check the xnat credentials
-    intf = getinterface(args.xnat_url,
-                        args.xnat_user,
-                        args.xnat_pwd)
 
-    # Extract information about the mrSessionsData
-    info = intf.select('xnat:mrSessionData',
-                       ['xnat:mrSessionData/SESSION_ID',
-                        'xnat:mrSessionData/PROJECT',
-                        'xnat:mrSessionData/SCANNER',
-                        'xnat:mrSessionData/SUBJECT_ID',
-                        'xnat:mrSessionData/VISIT',
-                        'xnat:mrSessionData/TYPE',
-                        'xnat:mrSessionData/'
-                        'XNAT_COL_MRSESSIONDATAFIELDSTRENGTH']
-                       ).all()
-    intf.disconnect()
+def readsidecar(scan_info_file):
+    """
+    Extract the session information used by the scanner report from an ADNI
+    xml file. The file is parsed incrementally and only until all the
+    fields are found, which is much cheaper than building the full tree as
+    getscaninfo does.
+    :param scan_info_file: xml filename
+    :return: dictionary containing the subject_id, session_id, date, site,
+    manufacturer, model, scanner, field_strength and type of the session
+    """
+    session = dict()
+    expected = len(SIDECAR_TAGS) + len(SIDECAR_TERMS)
+    with open(scan_info_file, 'rb') as f:
+        for _, element in ET.iterparse(f):
+            # Keep the first occurrence, as getscaninfo does with find
+            if element.tag in SIDECAR_TAGS:
+                session.setdefault(SIDECAR_TAGS[element.tag], element.text)
+            elif element.get('term') in SIDECAR_TERMS:
+                session.setdefault(SIDECAR_TERMS[element.get('term')],
+                                   element.text)
+            if len(session) == expected:
+                break
+    missing = [k for k in list(SIDECAR_TAGS.values()) +
+               list(SIDECAR_TERMS.values()) if k not in session]
+    if len(missing) > 0:
+        raise ValueError('Missing {} in {}'.format(', '.join(missing),
+                                                   scan_info_file))
+    # Same scanner name as the one set by upload_adni_data.py
+    session['scanner'] = session['manufacturer'] + '_' + session['model']
+    return {k: session[k] for k in ['subject_id', 'session_id', 'date',
+                                    'type', 'site', 'manufacturer', 'model',
+                                    'scanner', 'field_strength']}
 
-    # Store the data in a pandas DataFrame
-    raw_data = pd.DataFrame(info)
-    raw_data = raw_data[raw_data['project'] == args.project]
 
+def readsessions(input_path, workers=None):
+    """
+    Read the sessions of a local ADNI folder from its xml files, without
+    querying XNAT
+    :param input_path: path to the folder containing the ADNI data
+    :param workers: number of processes parsing the xml files, one per cpu
+    by default
+    :return: list of session dictionaries sorted by subject and date, with
+    one entry per session even when several images share it
+    """
+    scan_info_files = [f for files in findscaninfofiles(input_path).values()
+                       for f in files]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Large chunks keep the inter-process overhead low for small files
+        chunksize = max(1, len(scan_info_files) //
+                        (4 * (workers or os.cpu_count() or 1)))
+        results = list(executor.map(readsidecar, scan_info_files,
+                                    chunksize=chunksize))
+    sessions = dict()
+    for r in results:
+        sessions.setdefault((r['subject_id'], r['session_id']), r)
+    return sorted(sessions.values(),
+                  key=lambda s: (s['subject_id'], s['date'], s['session_id']))
+
+
+def exportsessions(sessions, filename):
+    """
+    Write the sessions used by the scanner report in a csv file
+    :param sessions: list of session dictionaries
+    :param filename: csv filename
+    """
+    columns = []
+    for s in sessions:
+        columns += [k for k in s if k not in columns]
+    with open(filename, 'w', newline='') as f:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        writer.writerows(sessions)
+
+
+def printscannerreport(sessions):
+    """
+    Display the number of sites, scanners and scans per field strength and
+    vendor, using the first baseline session of each subject
+    :param sessions: list of dictionaries containing the subject_id, site,
+    scanner, field_strength and type of each session
+    """
     print('List of visit types:')
-    for v in set(raw_data['type']):
+    for v in set(s['type'] for s in sessions):
         print('- ' + v)
 
     # Select only the baseline sessions
-    baseline = raw_data[(raw_data['type'] == 'ADNI Screening') |
-                        (raw_data['type'] == 'ADNI Baseline')]
+    baseline = [s for s in sessions
+                if s['type'] == 'ADNI Screening' or
+                s['type'] == 'ADNI Baseline']
     scanner_types = dict()
     scan_number = [0, 0]
     scanner_number = [0, 0]
@@ -91,12 +159,12 @@ if __name__ == '__main__':
     ge_number = [0, 0]
     philips_number = [0, 0]
     subject_list = []
-    for i, r in baseline.iterrows():
+    for r in baseline:
         if r['subject_id'] in subject_list:
             continue
         subject_list.append(r['subject_id'])
-        site = r['session_id'].split('_')[0]
-        strength = r['xnat_col_mrsessiondatafieldstrength']
+        site = r['site']
+        strength = r['field_strength']
         scanner = r['scanner'] + ' ' + strength
         strength = 0 if float(strength) < 2 else 1
         if site not in scanner_types.keys():
@@ -129,3 +197,100 @@ if __name__ == '__main__':
     print('Number of philips scans = {} ({}/{})'.format(sum(philips_number),
                                                         philips_number[0],
                                                         philips_number[1]))
+
+
+if __name__ == '__main__':
+    # Parser to set default values for xnat url and credentials
+    parser = argparse.ArgumentParser()
+    parser.add_argument('xnat_url',
+                        help='Default XNAT instance URL, not required with '
+                             '--mirror or --offline',
+                        type=str,
+                        nargs='?')
+    parser.add_argument('xnat_user',
+                        help='Default XNAT username',
+                        type=str,
+                        nargs='?')
+    parser.add_argument('xnat_pwd',
+                        help='Default XNAT password',
+                        type=str,
+                        nargs='?')
+    parser.add_argument('-p', '--project',
+                        help='XNAT project where the data will be uploaded',
+                        type=str,
+                        default='ADNI')
+    parser.add_argument('-m', '--mirror',
+                        help='Local mirror created with xnat_mirror.py, used '
+                             'instead of querying XNAT',
+                        type=str)
+    parser.add_argument('--offline',
+                        help='Local ADNI folder whose xml files are read '
+                             'instead of querying XNAT',
+                        type=str)
+    parser.add_argument('-j', '--workers',
+                        help='Number of processes reading the xml files '
+                             'with --offline, one per cpu by default',
+                        type=int)
+    parser.add_argument('-e', '--export',
+                        help='Save the sessions used by the report in this '
+                             'csv file',
+                        type=str)
+    args = parser.parse_args()
+
+    if args.offline is not None:
+        # Read the sessions from the ADNI xml files
+        sessions = readsessions(args.offline, args.workers)
+        printscannerreport(sessions)
+        if args.export is not None:
+            exportsessions(sessions, args.export)
+        sys.exit(0)
+    if args.mirror is not None:
+        # Read the sessions from the local mirror
+        db = openmirror(args.mirror)
+        sessions = [{'subject_id': r['subject_id'],
+                     'site': r['label'].split('_')[0],
+                     'scanner': r['scanner'],
+                     'field_strength': r['field_strength'],
+                     'type': r['session_type']}
+                    for r in getsessions(db, args.project)]
+        db.close()
+        printscannerreport(sessions)
+        if args.export is not None:
+            exportsessions(sessions, args.export)
+        sys.exit(0)
+    if args.xnat_pwd is None:
+        parser.error('the XNAT url and credentials are required')
+
+    # # Check the xnat credentials
+    intf = getinterface(args.xnat_url,
+                        args.xnat_user,
+                        args.xnat_pwd)
+
+    # Extract information about the mrSessionsData
+    loadschema(intf)
+    info = intf.select('xnat:mrSessionData',
+                       ['xnat:mrSessionData/SESSION_ID',
+                        'xnat:mrSessionData/PROJECT',
+                        'xnat:mrSessionData/SCANNER',
+                        'xnat:mrSessionData/SUBJECT_ID',
+                        'xnat:mrSessionData/VISIT',
+                        'xnat:mrSessionData/TYPE',
+                        'xnat:mrSessionData/'
+                        'XNAT_COL_MRSESSIONDATAFIELDSTRENGTH']
+                       ).all()
+    intf.disconnect()
+
+    # Store the data in a pandas DataFrame
+    import pandas as pd
+    raw_data = pd.DataFrame(info)
+    raw_data = raw_data[raw_data['project'] == args.project]
+
+    sessions = [{'subject_id': r['subject_id'],
+                 'site': r['session_id'].split('_')[0],
+                 'scanner': r['scanner'],
+                 'field_strength': r['xnat_col_mrsessiondatafieldstrength'],
+                 'type': r['type']}
+                for i, r in raw_data.iterrows()]
+    printscannerreport(sessions)
+    if args.export is not None:
+        exportsessions(sessions, args.export)
@@ -0,0 +1,78 @@
+import zlib
+import os
+
+# Size of the blocks read from disk and sent to XNAT
+CHUNK_SIZE = 1 << 20
+
+
+class FileChunks:
+    """
+    Iterable reading a file in fixed-size blocks, so that uploading it only
+    holds one block in memory. Its length is the file size, which lets
+    requests send a Content-Length header instead of chunked encoding.
+    """
+    def __init__(self, filename, chunk_size=CHUNK_SIZE):
+        """
+        :param filename: file to read
+        :param chunk_size: size of the blocks in bytes
+        """
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.size = os.path.getsize(filename)
+        self.sent = 0
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        self.sent = 0
+        with open(self.filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                self.sent += len(chunk)
+                yield chunk
+
+
+class GzipChunks:
+    """
+    Iterable compressing a file in gzip format while it is read, one block
+    at a time. The output size is unknown beforehand, so requests sends it
+    with chunked encoding. The gzip header has no name nor date so that
+    compressing the same file again gives the same bytes with the same zlib
+    version, which lets the sync mode compare digests.
+    """
+    def __init__(self, filename, chunk_size=CHUNK_SIZE, level=6):
+        """
+        :param filename: file to compress
+        :param chunk_size: size of the blocks read from disk in bytes
+        :param level: zlib compression level
+        """
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.level = level
+        self.size = os.path.getsize(filename)
+        self.sent = 0
+
+    def __iter__(self):
+        self.sent = 0
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        with open(self.filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                data = compressor.compress(chunk)
+                if len(data) > 0:
+                    self.sent += len(data)
+                    yield data
+        data = compressor.flush()
+        self.sent += len(data)
+        yield data
+
+
+def getstream(filename, chunk_size=CHUNK_SIZE, compress=False):
+    """
+    :param filename: file to upload
+    :param chunk_size: size of the blocks read from disk in bytes
+    :param compress: gzip the file on the fly
+    :return: FileChunks or GzipChunks object
+    """
+    if compress:
+        return GzipChunks(filename, chunk_size)
+    return FileChunks(filename, chunk_size)
@@ -0,0 +1,440 @@
+import xml.etree.ElementTree as ET
+import os.path as path
+import argparse
+import datetime
+import random
+import struct
+import array
+import json
+import zlib
+import os
+
+# Orientation codes give the direction of the i, j and k voxel axes
+AXES = {'R': (0, 1.), 'L': (0, -1.), 'A': (1, 1.), 'P': (1, -1.),
+        'S': (2, 1.), 'I': (2, -1.)}
+
+# Centres of the bright markers, in world coordinates relative to the
+# volume extent (R, A, S). Each one lies in a middle plane, far along the
+# first of the two other axes and close along the second, so that flips
+# and swapped axes are visible in the snapshots.
+MARKERS = [(0., .45, .2), (.45, 0., .2), (.45, .2, 0.)]
+MARKER_RADIUS = .15
+
+# Nifti datatype code, array typecode and bits per voxel
+DATATYPES = {'uint8': (2, 'B', 8), 'int16': (4, 'h', 16),
+             'float32': (16, 'f', 32)}
+
+# Series descriptions of a visit, as found in the ADNI downloads
+DESCRIPTIONS = ['MPR__GradWarp__B1_Correction__N3__Scaled',
+                'MPR-R__GradWarp__B1_Correction__N3__Scaled',
+                'MT1__N3m',
+                'Axial_PD_T2_FSE']
+VISITS = ['ADNI Screening', 'ADNI1/GO Month 6', 'ADNI1/GO Month 12',
+          'ADNI1/GO Month 18', 'ADNI1/GO Month 24', 'ADNI1/GO Month 36']
+SCANNERS = [('SIEMENS', 'Symphony', '1.5'), ('SIEMENS', 'TrioTim', '3.0'),
+            ('GE MEDICAL SYSTEMS', 'SIGNA EXCITE', '1.5'),
+            ('GE MEDICAL SYSTEMS', 'DISCOVERY MR750', '3.0'),
+            ('Philips Medical Systems', 'Intera', '1.5'),
+            ('Philips Medical Systems', 'Achieva', '3.0')]
+GROUPS = ['CN', 'MCI', 'AD']
+
+
+def getorientationmatrix(orientation, spacing):
+    """
+    Build the voxel to world matrix of an orientation code
+    :param orientation: three letters code, e.g. LAS or RPI
+    :param spacing: list containing the voxel size along each voxel axis
+    :return: 3x3 matrix as a list of rows
+    """
+    orientation = orientation.upper()
+    if len(orientation) != 3 or any(o not in AXES for o in orientation) or \
+            len(set(AXES[o][0] for o in orientation)) != 3:
+        raise ValueError('Invalid orientation ' + orientation)
+    matrix = [[0., 0., 0.], [0., 0., 0.], [0., 0., 0.]]
+    for voxel, o in enumerate(orientation):
+        world, sign = AXES[o]
+        matrix[world][voxel] = sign * spacing[voxel]
+    return matrix
+
+
+def randomorientation(rand):
+    """
+    :param rand: random.Random object
+    :return: random valid orientation code
+    """
+    axes = [('R', 'L'), ('A', 'P'), ('S', 'I')]
+    rand.shuffle(axes)
+    return ''.join(rand.choice(a) for a in axes)
+
+
+def makeheader(shape, volumes, datatype, spacing, matrix):
+    """
+    Build a nifti-1 header with the sform set to the voxel to world matrix
+    :param shape: list containing the number of voxels along each axis
+    :param volumes: number of volumes
+    :param datatype: key of DATATYPES
+    :param spacing: list containing the voxel size along each voxel axis
+    :param matrix: 3x3 voxel to world matrix
+    :return: 352 bytes containing the header and an empty extension
+    """
+    code, _, bitpix = DATATYPES[datatype]
+    header = bytearray(352)
+    struct.pack_into('<i', header, 0, 348)
+    dim = [4 if volumes > 1 else 3] + list(shape) + [volumes, 1, 1, 1]
+    struct.pack_into('<8h', header, 40, *dim[:8])
+    struct.pack_into('<2h', header, 70, code, bitpix)
+    struct.pack_into('<8f', header, 76, 1., *(list(spacing) + [0.] * 4))
+    struct.pack_into('<f', header, 108, 352.)
+    struct.pack_into('<f', header, 112, 1.)
+    # Units in mm and seconds
+    header[123] = 2 | 8
+    # No qform, scanner based sform
+    struct.pack_into('<2h', header, 252, 0, 1)
+    centre = [-sum(matrix[r][c] * (shape[c] - 1) / 2. for c in range(3))
+              for r in range(3)]
+    srow = [matrix[r] + [centre[r]] for r in range(3)]
+    struct.pack_into('<12f', header, 280, *(v for r in srow for v in r))
+    header[344:348] = b'n+1\x00'
+    return bytes(header)
+
+
+def makevolume(shape, datatype, matrix):
+    """
+    Draw a phantom made of two nested ellipsoids and a bright sphere cut by
+    each middle plane: anterior superior in the sagittal plane, right
+    superior in the coronal plane and right anterior in the axial plane,
+    so that snapshots show whether the orientation was handled properly
+    :param shape: list containing the number of voxels along each axis
+    :param datatype: key of DATATYPES
+    :param matrix: 3x3 voxel to world matrix
+    :return: voxel values as little endian bytes
+    """
+    nx, ny, nz = shape
+    # World extent of the volume along each axis
+    extent = [sum(abs(matrix[r][c]) * shape[c] for c in range(3)) / 2.
+              for r in range(3)]
+    maximum = 255 if datatype == 'uint8' else 1000
+    values = array.array(DATATYPES[datatype][1], bytes(
+        nx * ny * nz * DATATYPES[datatype][2] // 8))
+    n = 0
+    for k in range(nz):
+        for j in range(ny):
+            for i in range(nx):
+                world = [(matrix[r][0] * (i - (nx - 1) / 2.) +
+                          matrix[r][1] * (j - (ny - 1) / 2.) +
+                          matrix[r][2] * (k - (nz - 1) / 2.)) / extent[r]
+                         for r in range(3)]
+                radius = (world[0] ** 2 + world[1] ** 2 +
+                          world[2] ** 2) ** 0.5
+                marker = min(((world[0] - m[0]) ** 2 +
+                              (world[1] - m[1]) ** 2 +
+                              (world[2] - m[2]) ** 2) ** 0.5
+                             for m in MARKERS)
+                if marker < MARKER_RADIUS:
+                    values[n] = maximum
+                elif radius < .5:
+                    values[n] = int(maximum * .6)
+                elif radius < .8:
+                    values[n] = int(maximum * .3)
+                n += 1
+    if struct.pack('=h', 1)[0] != 1:
+        values.byteswap()
+    return values.tobytes()
+
+
+def compress(data, flush_spacing=0, level=6):
+    """
+    Gzip data, optionally with a full flush every flush_spacing bytes as
+    done by pigz -i, to reproduce the files written by such tools
+    :param data: bytes to compress
+    :param flush_spacing: uncompressed bytes between flush points, 0 for a
+    plain gzip stream
+    :param level: compression level
+    :return: gzip compressed bytes
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    if flush_spacing <= 0:
+        return compressor.compress(data) + compressor.flush()
+    chunks = []
+    for offset in range(0, len(data), flush_spacing):
+        chunks.append(compressor.compress(data[offset:offset +
+                                               flush_spacing]))
+        chunks.append(compressor.flush(zlib.Z_FULL_FLUSH))
+    chunks.append(compressor.flush())
+    return b''.join(chunks)
+
+
+def makescaninfo(scan):
+    """
+    Build the xml sidecar of a scan with every field read by getscaninfo
+    :param scan: dictionary describing the fake scan
+    :return: ElementTree object
+    """
+    root = ET.Element('idaxs')
+    project = ET.SubElement(root, 'project')
+    ET.SubElement(project, 'projectIdentifier').text = 'ADNI'
+    ET.SubElement(project, 'siteKey').text = scan['site']
+    subject = ET.SubElement(project, 'subject')
+    ET.SubElement(subject, 'subjectIdentifier').text = scan['subject_id']
+    ET.SubElement(subject, 'researchGroup').text = scan['group']
+    ET.SubElement(subject, 'subjectSex').text = scan['sex']
+    ET.SubElement(subject, 'subjectInfo', item='APOE A1').text = \
+        scan['apoe'][0]
+    ET.SubElement(subject, 'subjectInfo', item='APOE A2').text = \
+        scan['apoe'][1]
+
+    visit = ET.SubElement(subject, 'visit')
+    ET.SubElement(visit, 'visitIdentifier').text = scan['visit']
+    for name, attribute, score in [('mmse', 'MMSCORE', scan['mmse']),
+                                   ('cdr', 'CDGLOBAL', scan['cdr']),
+                                   ('gds', 'GDTOTAL', scan['gds']),
+                                   ('faq', 'FAQTOTAL', scan['faq'])]:
+        assessment = ET.SubElement(visit, 'assessment', attribute=name)
+        component = ET.SubElement(assessment, 'component')
+        ET.SubElement(component, 'assessmentScore',
+                      attribute=attribute).text = score
+    assessment = ET.SubElement(visit, 'assessment', attribute='npi')
+    ET.SubElement(assessment, 'assessmentScore',
+                  attribute='NPISCORE').text = scan['npi']
+
+    study = ET.SubElement(subject, 'study')
+    ET.SubElement(study, 'subjectAge').text = scan['age']
+    series = ET.SubElement(study, 'series')
+    ET.SubElement(series, 'seriesIdentifier').text = scan['series_id']
+    ET.SubElement(series, 'modality').text = 'MRI'
+    ET.SubElement(series, 'dateAcquired').text = scan['date']
+    protocol = ET.SubElement(study, 'imagingProtocol')
+    ET.SubElement(protocol, 'imageUID').text = scan['image_id'][1:]
+    terms = ET.SubElement(protocol, 'protocolTerm')
+    manufacturer, model, field_strength = scan['scanner']
+    for term, value in [('Acquisition Plane', 'SAGITTAL'),
+                        ('Coil', '8HRBRAIN'),
+                        ('Field Strength', field_strength),
+                        ('Flip Angle', '8.0'),
+                        ('Manufacturer', manufacturer),
+                        ('Matrix X', str(scan['shape'][0])),
+                        ('Matrix Y', str(scan['shape'][1])),
+                        ('Matrix Z', str(scan['shape'][2])),
+                        ('Mfg Model', model),
+                        ('Pixel Spacing X', str(scan['spacing'][0])),
+                        ('Pixel Spacing Y', str(scan['spacing'][1])),
+                        ('Pulse Sequence', 'GR/IR'),
+                        ('Slice Thickness', str(scan['spacing'][2])),
+                        ('TE', '3.6'),
+                        ('TI', '1000.0'),
+                        ('TR', '3000.0'),
+                        ('Weighting', 'T1')]:
+        ET.SubElement(terms, 'protocol', term=term).text = value
+    derived = ET.SubElement(study, 'derivedProduct')
+    ET.SubElement(derived, 'processedDataLabel').text = \
+        scan['description'].replace('__', '; ').replace('_', ' ')
+    return ET.ElementTree(root)
+
+
+def generatescans(scans, scans_per_visit=2, visits_per_subject=3, seed=0,
+                  orientations=('LAS',), shape=(32, 32, 24),
+                  spacing=(1.2, 1., 1.)):
+    """
+    Describe the fake scans of the dataset
+    :param scans: number of scans
+    :param scans_per_visit: number of series descriptions used per visit
+    :param visits_per_subject: number of visits of each subject
+    :param seed: seed of the random generator
+    :param orientations: list of orientation codes used in turn, 'random'
+    picks a random orientation for each scan
+    :param shape: number of voxels along each axis
+    :param spacing: voxel size along each axis
+    :return: generator of dictionaries describing each scan
+    """
+    rand = random.Random(seed)
+    scans_per_subject = scans_per_visit * visits_per_subject
+    first_date = datetime.datetime(2005, 9, 1, 8, 0, 0)
+    subject = None
+    for n in range(scans):
+        if n % scans_per_subject == 0:
+            site = '{:03d}'.format(rand.randint(2, 150))
+            subject = {'site': site,
+                       'subject_id': '{}_S_{:04d}'.format(
+                           site, n // scans_per_subject + 1),
+                       'group': rand.choice(GROUPS),
+                       'sex': rand.choice(['M', 'F']),
+                       'apoe': [str(rand.choice([2, 3, 4])),
+                                str(rand.choice([2, 3, 4]))],
+                       'age': rand.uniform(55., 90.),
+                       'scanner': rand.choice(SCANNERS),
+                       'start': first_date + datetime.timedelta(
+                           days=rand.randint(0, 365), minutes=rand.randint(
+                               0, 600))}
+        visit = n % scans_per_subject // scans_per_visit
+        if n % scans_per_visit == 0:
+            acquired = subject['start'] + datetime.timedelta(
+                days=182 * visit)
+        orientation = orientations[n % len(orientations)]
+        if orientation == 'random':
+            orientation = randomorientation(rand)
+        yield {'site': subject['site'],
+               'subject_id': subject['subject_id'],
+               'group': subject['group'],
+               'sex': subject['sex'],
+               'apoe': subject['apoe'],
+               'age': '{:.1f}'.format(subject['age'] + visit / 2.),
+               'scanner': subject['scanner'],
+               'visit': VISITS[min(visit, len(VISITS) - 1)],
+               'series_id': 'S{}'.format(10000 + n // scans_per_visit),
+               'image_id': 'I{}'.format(100000 + n),
+               'description': DESCRIPTIONS[n % scans_per_visit %
+                                           len(DESCRIPTIONS)],
+               'date': acquired.strftime('%Y-%m-%d'),
+               'time': acquired.strftime('%Y-%m-%d_%H_%M_%S.0'),
+               'mmse': str(rand.randint(15, 30)),
+               'cdr': rand.choice(['0.0', '0.5', '1.0']),
+               'gds': str(rand.randint(0, 6)),
+               'faq': str(rand.randint(0, 20)),
+               'npi': str(rand.randint(0, 10)),
+               'orientation': orientation,
+               'shape': list(shape),
+               'spacing': list(spacing)}
+
+
+def writedataset(output_path, scans, scans_per_visit=2, visits_per_subject=3,
+                 shape=(32, 32, 24), spacing=(1.2, 1., 1.), volumes=1,
+                 datatype='int16', orientations=('LAS',), flush_spacing=0,
+                 seed=0, verbose=True):
+    """
+    Write a fake ADNI folder with the layout of the ADNI downloads:
+    ADNI/<subject>/<description>/<date>/<image>/ADNI_..._<image>.nii.gz and
+    ADNI/ADNI_..._<image>.xml
+    :param output_path: folder in which the ADNI folder is created
+    :param scans: number of scans
+    :param scans_per_visit: number of series descriptions used per visit
+    :param visits_per_subject: number of visits of each subject
+    :param shape: number of voxels along each axis
+    :param spacing: voxel size along each axis
+    :param volumes: number of volumes of each image
+    :param datatype: key of DATATYPES
+    :param orientations: list of orientation codes used in turn, 'random'
+    picks a random orientation for each scan
+    :param flush_spacing: uncompressed bytes between gzip flush points, 0
+    for plain gzip files
+    :param seed: seed of the random generator
+    :param verbose: print the progress
+    :return: dictionary describing the generated dataset
+    """
+    adni_dir = path.join(output_path, 'ADNI')
+    os.makedirs(adni_dir, exist_ok=True)
+    # The image content only depends on the orientation, compress it once
+    images = dict()
+    total_size = 0
+    for n, scan in enumerate(generatescans(scans, scans_per_visit,
+                                           visits_per_subject, seed,
+                                           orientations, shape, spacing)):
+        if scan['orientation'] not in images:
+            matrix = getorientationmatrix(scan['orientation'], spacing)
+            volume = makevolume(shape, datatype, matrix)
+            images[scan['orientation']] = compress(
+                makeheader(shape, volumes, datatype, spacing, matrix) +
+                volume * volumes, flush_spacing)
+
+        name = 'ADNI_{}_MR_{}_Br_{}_{}_{}'.format(
+            scan['subject_id'], scan['description'],
+            scan['date'].replace('-', '') + '000000000', scan['series_id'],
+            scan['image_id'])
+        scan_dir = path.join(adni_dir, scan['subject_id'],
+                             scan['description'], scan['time'],
+                             scan['image_id'])
+        os.makedirs(scan_dir, exist_ok=True)
+        with open(path.join(scan_dir, name + '.nii.gz'), 'wb') as f:
+            f.write(images[scan['orientation']])
+        total_size += len(images[scan['orientation']])
+
+        scan_info_file = path.join(adni_dir, 'ADNI_{}_{}_{}_{}.xml'.format(
+            scan['subject_id'], scan['description'], scan['series_id'],
+            scan['image_id']))
+        makescaninfo(scan).write(scan_info_file, encoding='utf-8',
+                                 xml_declaration=True)
+        if verbose and (n + 1) % 1000 == 0:
+            print('{} scans written'.format(n + 1))
+
+    dataset = {'scans': scans,
+               'scans_per_visit': scans_per_visit,
+               'visits_per_subject': visits_per_subject,
+               'shape': list(shape),
+               'spacing': list(spacing),
+               'volumes': volumes,
+               'datatype': datatype,
+               'orientations': list(orientations),
+               'flush_spacing': flush_spacing,
+               'seed': seed,
+               'size': total_size}
+    with open(path.join(output_path, 'fake_adni.json'), 'w') as f:
+        json.dump(dataset, f, indent=1)
+    return dataset
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Write a fake ADNI folder that upload_adni_data.py can '
+                    'process, to reproduce performance issues without '
+                    'sharing ADNI data')
+    parser.add_argument('output_path',
+                        help='Folder in which the ADNI folder is created',
+                        type=str)
+    parser.add_argument('-n', '--scans',
+                        help='Number of scans',
+                        type=int,
+                        default=1000)
+    parser.add_argument('--scans-per-visit',
+                        help='Number of series per visit, each with its own '
+                             'description',
+                        type=int,
+                        default=2)
+    parser.add_argument('--visits-per-subject',
+                        help='Number of visits per subject',
+                        type=int,
+                        default=3)
+    parser.add_argument('--shape',
+                        help='Number of voxels along each axis',
+                        type=int,
+                        nargs=3,
+                        default=[32, 32, 24])
+    parser.add_argument('--spacing',
+                        help='Voxel size along each axis in mm',
+                        type=float,
+                        nargs=3,
+                        default=[1.2, 1., 1.])
+    parser.add_argument('--volumes',
+                        help='Number of volumes of each image',
+                        type=int,
+                        default=1)
+    parser.add_argument('--datatype',
+                        help='Voxel type',
+                        choices=sorted(DATATYPES),
+                        default='int16')
+    parser.add_argument('--orientation',
+                        help='Orientation codes of the images, e.g. LAS or '
+                             'RPI, used in turn. Use random to draw one for '
+                             'each scan',
+                        type=str,
+                        nargs='+',
+                        default=['LAS'])
+    parser.add_argument('--flush-spacing',
+                        help='Uncompressed bytes between gzip flush points, '
+                             '0 for plain gzip files',
+                        type=int,
+                        default=0)
+    parser.add_argument('--seed',
+                        help='Seed of the random generator',
+                        type=int,
+                        default=0)
+    args = parser.parse_args()
+
+    for o in args.orientation:
+        if o != 'random':
+            getorientationmatrix(o, args.spacing)
+    dataset = writedataset(args.output_path, args.scans,
+                           args.scans_per_visit, args.visits_per_subject,
+                           args.shape, args.spacing, args.volumes,
+                           args.datatype, args.orientation,
+                           args.flush_spacing, args.seed)
+    print('{} scans written in {} ({:.1f} MB)'.format(
+        args.scans, args.output_path, dataset['size'] / 1e6))
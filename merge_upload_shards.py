@@ -0,0 +1,134 @@
+import argparse
+import json
+import sys
+
+
+def mergereports(reports):
+    """
+    Combine the reports written by upload_adni_data.py --report
+    :param reports: list of report dictionaries
+    :return: dictionary containing the merged counts, the duration from the
+    first start to the last end and the missing or duplicated shards
+    """
+    shards = set(r['shard'][1] for r in reports)
+    if len(shards) != 1:
+        raise ValueError('Reports use different numbers of shards: ' +
+                         ', '.join(str(s) for s in sorted(shards)))
+    shards = shards.pop()
+    indexes = [r['shard'][0] for r in reports]
+    merged = {'shards': shards,
+              'missing': [i for i in range(shards) if i not in indexes],
+              'duplicated': sorted(set(i for i in indexes
+                                       if indexes.count(i) > 1)),
+              'hosts': sorted(set(r['host'] for r in reports)),
+              'started': min(r['started'] for r in reports),
+              'finished': max(r['finished'] for r in reports),
+              'slowest': max(r['duration'] for r in reports),
+              'scans': sum(r['scans'] for r in reports),
+              'journal_skipped': sum(r['journal_skipped'] for r in reports),
+              'unchanged': sum(r['unchanged'] for r in reports),
+              'sent_bytes': sum(r.get('sent_bytes', 0) for r in reports),
+              'summary': dict()}
+    for r in reports:
+        for k, v in r['summary'].items():
+            merged['summary'][k] = merged['summary'].get(k, 0) + v
+    return merged
+
+
+def mergejournals(journal_files, output_file):
+    """
+    Concatenate the shard journals, keeping the last entry of each scan
+    :param journal_files: list of json lines filenames
+    :param output_file: merged journal filename, can be None
+    :return: tuple containing the number of scans and the list of scans
+    recorded by more than one shard
+    """
+    entries = dict()
+    shards = dict()
+    for journal_file in journal_files:
+        with open(journal_file) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Truncated last line of a killed run
+                    continue
+                entries[entry['scan']] = entry
+                shards.setdefault(entry['scan'], set()).add(entry['shard'])
+    overlapping = sorted(s for s in shards if len(shards[s]) > 1)
+    if output_file is not None:
+        with open(output_file, 'w') as f:
+            for entry in sorted(entries.values(), key=lambda e: e['date']):
+                f.write(json.dumps(entry) + '\n')
+    return len(entries), overlapping
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Merge the reports and journals of a sharded upload '
+                    '(upload_adni_data.py --shard i/N)')
+    parser.add_argument('-r', '--reports',
+                        help='Reports written with --report',
+                        type=str,
+                        nargs='+',
+                        default=[])
+    parser.add_argument('-j', '--journals',
+                        help='Journals written with --journal',
+                        type=str,
+                        nargs='+',
+                        default=[])
+    parser.add_argument('-o', '--output',
+                        help='Save the merged report in this json file',
+                        type=str)
+    parser.add_argument('--journal',
+                        help='Save the merged journal in this file, it can '
+                             'be used by later runs whatever their sharding',
+                        type=str)
+    args = parser.parse_args()
+    if len(args.reports) == 0 and len(args.journals) == 0:
+        parser.error('no report or journal to merge')
+
+    failed = False
+    if len(args.reports) > 0:
+        reports = []
+        for report_file in args.reports:
+            with open(report_file) as f:
+                reports.append(json.load(f))
+        merged = mergereports(reports)
+        for r in sorted(reports, key=lambda r: r['shard'][0]):
+            print('Shard {}/{} on {}: {} scans, {} uploaded, {:.1f} MB in '
+                  '{:.0f}s'.format(r['shard'][0], r['shard'][1], r['host'],
+                                   r['scans'], r['summary']['scans'],
+                                   r['summary']['bytes'] / 1e6,
+                                   r['duration']))
+        print('Total: {} scans, {} subjects, {} experiments and {} scans '
+              'created, {} files ({:.1f} MB) uploaded, {} unchanged, {} '
+              'skipped from journals'.format(
+                  merged['scans'], merged['summary']['subjects'],
+                  merged['summary']['experiments'],
+                  merged['summary']['scans'], merged['summary']['files'],
+                  merged['summary']['bytes'] / 1e6, merged['unchanged'],
+                  merged['journal_skipped']))
+        print('From {} to {}, slowest shard took {:.0f}s'.format(
+            merged['started'], merged['finished'], merged['slowest']))
+        if len(merged['missing']) > 0:
+            failed = True
+            print('Missing shards: ' +
+                  ', '.join(str(i) for i in merged['missing']))
+        if len(merged['duplicated']) > 0:
+            print('Shards reported more than once: ' +
+                  ', '.join(str(i) for i in merged['duplicated']))
+        if args.output is not None:
+            with open(args.output, 'w') as f:
+                json.dump(merged, f, indent=1)
+
+    if len(args.journals) > 0:
+        scans, overlapping = mergejournals(args.journals, args.journal)
+        print('Journals: {} completed scans'.format(scans))
+        if len(overlapping) > 0:
+            # Happens when the number of shards changed between runs
+            print('Scans recorded by several shards: {}'.format(
+                len(overlapping)))
+
+    if failed:
+        sys.exit(1)
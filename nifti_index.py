@@ -0,0 +1,273 @@
+import struct
+import array
+import zlib
+
+# Size of the compressed blocks read from disk
+CHUNK = 1 << 16
+# Maximum number of bytes decoded at once
+DECODE_SIZE = 1 << 20
+
+# Nifti datatype codes and their array typecodes
+DATATYPES = {2: 'B', 4: 'h', 8: 'i', 16: 'f', 64: 'd',
+             256: 'b', 512: 'H', 768: 'I'}
+
+
+class GzipReader:
+    """
+    Sequential reader of gzip files, including files made of several
+    members such as those written by bgzip. Reads can only move forward,
+    skipped bytes are decoded and dropped, so that a file is decoded at most
+    once and only up to the last byte requested.
+    """
+    def __init__(self, filename):
+        """
+        :param filename: gzip filename
+        """
+        self.filename = filename
+        self.f = open(filename, 'rb')
+        self.d = zlib.decompressobj(31)
+        # Uncompressed offset of the first buffered byte
+        self.pos = 0
+        self.buffer = b''
+
+    def decode(self):
+        """
+        Decode the next bytes of the file
+        :return: decoded bytes, empty at the end of the file
+        """
+        while True:
+            if self.d.eof:
+                # Start of the next member, gzip ignores trailing zeros
+                data = self.d.unused_data.lstrip(b'\x00')
+                if len(data) == 0:
+                    data = self.f.read(CHUNK).lstrip(b'\x00')
+                    if len(data) == 0:
+                        return b''
+                self.d = zlib.decompressobj(31)
+            else:
+                data = self.d.unconsumed_tail or self.f.read(CHUNK)
+                if len(data) == 0:
+                    return b''
+            out = self.d.decompress(data, DECODE_SIZE)
+            if len(out) > 0:
+                return out
+
+    def read(self, offset, length):
+        """
+        Read uncompressed bytes
+        :param offset: uncompressed offset, not before the end of the
+        previous read
+        :param length: number of bytes to read
+        :return: bytes
+        """
+        if offset < self.pos:
+            raise ValueError('GzipReader cannot read backwards')
+        # Drop the bytes before the offset
+        while self.pos + len(self.buffer) < offset:
+            self.pos += len(self.buffer)
+            self.buffer = self.decode()
+            if len(self.buffer) == 0:
+                raise EOFError('Offset beyond the end of ' + self.filename)
+        data = [self.buffer[offset - self.pos:]]
+        size = len(data[0])
+        while size < length:
+            out = self.decode()
+            if len(out) == 0:
+                raise EOFError('Offset beyond the end of ' + self.filename)
+            data.append(out)
+            size += len(out)
+        data = b''.join(data)
+        self.buffer = data[length:]
+        self.pos = offset + length
+        return data[:length]
+
+    def close(self):
+        self.f.close()
+
+
+class RawReader:
+    """
+    Minimal reader for uncompressed nifti images, with the same interface
+    as GzipReader
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.f = open(filename, 'rb')
+
+    def read(self, offset, length):
+        self.f.seek(offset)
+        data = self.f.read(length)
+        if len(data) < length:
+            raise EOFError('Offset beyond the end of ' + self.filename)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+def readniftiheader(reader):
+    """
+    Parse the header of a nifti-1 image
+    :param reader: GzipReader or RawReader object
+    :return: dictionary containing the dimensions, datatype, voxel offset,
+    endianness and the voxel to world matrix
+    """
+    raw = reader.read(0, 348)
+    endian = '<'
+    if struct.unpack('<i', raw[:4])[0] != 348:
+        endian = '>'
+        if struct.unpack('>i', raw[:4])[0] != 348:
+            raise ValueError('Not a nifti-1 image')
+    dim = struct.unpack(endian + '8h', raw[40:56])
+    datatype, bitpix = struct.unpack(endian + '2h', raw[70:74])
+    pixdim = struct.unpack(endian + '8f', raw[76:108])
+    vox_offset = int(struct.unpack(endian + 'f', raw[108:112])[0])
+    qform_code, sform_code = struct.unpack(endian + '2h', raw[252:256])
+    if datatype not in DATATYPES:
+        raise ValueError('Unsupported nifti datatype {}'.format(datatype))
+
+    if sform_code > 0:
+        srow = struct.unpack(endian + '12f', raw[280:328])
+        matrix = [list(srow[0:3]), list(srow[4:7]), list(srow[8:11])]
+    elif qform_code > 0:
+        b, c, d = struct.unpack(endian + '3f', raw[256:268])
+        a = max(0., 1. - b * b - c * c - d * d) ** 0.5
+        qfac = -1. if pixdim[0] < 0 else 1.
+        matrix = [[a * a + b * b - c * c - d * d, 2 * (b * c - a * d),
+                   qfac * 2 * (b * d + a * c)],
+                  [2 * (b * c + a * d), a * a + c * c - b * b - d * d,
+                   qfac * 2 * (c * d - a * b)],
+                  [2 * (b * d - a * c), 2 * (c * d + a * b),
+                   qfac * (a * a + d * d - c * c - b * b)]]
+    else:
+        matrix = [[pixdim[1], 0., 0.], [0., pixdim[2], 0.],
+                  [0., 0., pixdim[3]]]
+
+    return {'dim': [max(1, d) for d in dim[1:4]],
+            'typecode': DATATYPES[datatype],
+            'bitpix': bitpix,
+            'vox_offset': vox_offset,
+            'endian': endian,
+            'matrix': matrix}
+
+
+def getorientation(matrix):
+    """
+    Find, for each world axis (R, A, S), the voxel axis pointing along it
+    and whether it has to be flipped
+    :param matrix: 3x3 voxel to world matrix
+    :return: list of (voxel axis, flip) tuples for the R, A and S axes
+    """
+    orientation = [None, None, None]
+    available = [0, 1, 2]
+    for world in sorted(range(3), key=lambda w: -max(abs(v)
+                                                     for v in matrix[w])):
+        voxel = max(available, key=lambda v: abs(matrix[world][v]))
+        available.remove(voxel)
+        orientation[world] = (voxel, matrix[world][voxel] < 0)
+    return orientation
+
+
+def readmidplanes(filename):
+    """
+    Extract the middle sagittal, coronal and axial planes of the first
+    volume of a nifti image, in the orientation obtained with
+    fslswapdim LR PA IS. The first volume is decoded sequentially one slice
+    at a time and only up to its end, the row and column of the other
+    planes being gathered from each slice with strided reads.
+    :param filename: .nii.gz or .nii filename
+    :return: list of three planes, each a list of rows from top to bottom
+    """
+    if filename.endswith('.gz'):
+        reader = GzipReader(filename)
+    else:
+        reader = RawReader(filename)
+    try:
+        header = readniftiheader(reader)
+        nx, ny, nz = header['dim']
+        itemsize = header['bitpix'] // 8
+        orientation = getorientation(header['matrix'])
+
+        # Middle index of each voxel axis once reoriented
+        middle = [0, 0, 0]
+        for voxel, flip in orientation:
+            n = header['dim'][voxel]
+            middle[voxel] = n - 1 - n // 2 if flip else n // 2
+
+        def toarray(data):
+            values = array.array(header['typecode'], data)
+            if (header['endian'] == '<') != (struct.pack('=h', 1)[0] == 1):
+                values.byteswap()
+            return values
+
+        slice_size = nx * ny * itemsize
+        planes = {0: [], 1: [], 2: None}
+        for k in range(nz):
+            offset = header['vox_offset'] + k * slice_size
+            values = toarray(reader.read(offset, slice_size))
+            if k == middle[2]:
+                planes[2] = [values[j * nx:(j + 1) * nx] for j in range(ny)]
+            # Plane of constant j and plane of constant i
+            planes[1].append(values[middle[1] * nx:(middle[1] + 1) * nx])
+            planes[0].append(values[middle[0]::nx])
+    finally:
+        reader.close()
+
+    # planes[v] is indexed [slower voxel axis][faster voxel axis]
+    plane_axes = {0: (2, 1), 1: (2, 0), 2: (1, 0)}
+    voxel_to_world = {orientation[w][0]: w for w in range(3)}
+    results = []
+    # Sagittal (constant R), coronal (constant A) and axial (constant S)
+    for world, (column_world, row_world) in enumerate([(1, 2), (0, 2),
+                                                        (0, 1)]):
+        voxel = orientation[world][0]
+        plane = [list(r) for r in planes[voxel]]
+        slow, fast = plane_axes[voxel]
+        # Make the rows follow row_world and the columns column_world
+        if voxel_to_world[fast] != column_world:
+            plane = [list(r) for r in zip(*plane)]
+        if orientation[column_world][1]:
+            plane = [r[::-1] for r in plane]
+        # The top of the image is the superior or anterior side
+        if not orientation[row_world][1]:
+            plane = plane[::-1]
+        results.append(plane)
+    return results
+
+
+def scaleplanes(planes, low=2., high=98.):
+    """
+    Map the plane intensities to 8 bits between two percentiles, as slicer
+    does with its default robust range
+    :param planes: list of planes returned by readmidplanes
+    :param low: lower percentile
+    :param high: upper percentile
+    :return: list of planes containing integers between 0 and 255
+    """
+    values = sorted(v for p in planes for r in p for v in r)
+    vmin = values[int(low / 100. * (len(values) - 1))]
+    vmax = values[int(high / 100. * (len(values) - 1))]
+    scale = 255. / (vmax - vmin) if vmax > vmin else 0.
+    return [[[min(255, max(0, int((v - vmin) * scale))) for v in r]
+             for r in p] for p in planes]
+
+
+def rendersnapshot(scan_file, filename_snap):
+    """
+    Write the middle sagittal, coronal and axial planes of a scan side by
+    side in a png file, replacing fslswapdim and slicer -a
+    :param scan_file: .nii.gz or .nii filename
+    :param filename_snap: png filename
+    """
+    from PIL import Image
+    planes = scaleplanes(readmidplanes(scan_file))
+    width = sum(len(p[0]) for p in planes)
+    height = max(len(p) for p in planes)
+    snapshot = Image.new('L', (width, height))
+    x = 0
+    for p in planes:
+        image = Image.frombytes('L', (len(p[0]), len(p)),
+                                bytes(v for r in p for v in r))
+        snapshot.paste(image, (x, (height - len(p)) // 2))
+        x += len(p[0])
+    snapshot.save(filename_snap)
@@ -0,0 +1,163 @@
+import contextlib
+import threading
+import json
+import time
+import os
+
+
+class Tracer:
+    """
+    Record the duration of the stages of a pipeline as spans, which can be
+    saved in the Chrome trace event format (chrome://tracing or
+    https://ui.perfetto.dev) and summarised per stage
+    """
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.started = time.time()
+        self.pid = os.getpid()
+        self.threads = dict()
+
+    def threadid(self):
+        """
+        :return: small integer identifying the current thread in the trace
+        """
+        ident = threading.get_ident()
+        if ident not in self.threads:
+            self.threads[ident] = (len(self.threads) + 1,
+                                   threading.current_thread().name)
+        return self.threads[ident][0]
+
+    def add(self, name, start, end, args=None):
+        """
+        Record a span
+        :param name: stage name
+        :param start: time.perf_counter() at the start of the stage
+        :param end: time.perf_counter() at the end of the stage
+        :param args: dictionary displayed with the span, e.g. the scan id
+        """
+        with self.lock:
+            event = {'name': name,
+                     'cat': name.split(' ')[0],
+                     'ph': 'X',
+                     'ts': (start - self.origin) * 1e6,
+                     'dur': (end - start) * 1e6,
+                     'pid': self.pid,
+                     'tid': self.threadid()}
+            if args:
+                event['args'] = args
+            self.events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        """
+        Context manager recording the duration of its block, even if it
+        raises an exception
+        :param name: stage name
+        :param args: values displayed with the span, e.g. scan=scan_id
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.perf_counter(), args)
+
+    def iterate(self, iterable, name):
+        """
+        Record the time spent waiting for each item of an iterable, e.g. a
+        generator discovering files
+        :param iterable: iterable to wrap
+        :param name: stage name
+        :return: generator of the items of the iterable
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(name, start, time.perf_counter())
+                return
+            self.add(name, start, time.perf_counter())
+            yield item
+
+    def save(self, filename):
+        """
+        Write the spans in the Chrome trace event format
+        :param filename: json filename
+        """
+        with self.lock:
+            metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': self.pid,
+                         'tid': tid, 'args': {'name': name}}
+                        for tid, name in self.threads.values()]
+            events = metadata + list(self.events)
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events,
+                       'displayTimeUnit': 'ms',
+                       'otherData': {'started': time.strftime(
+                           '%Y-%m-%d %H:%M:%S',
+                           time.localtime(self.started))}}, f)
+
+    def summary(self):
+        """
+        Aggregate the spans per stage
+        :return: dictionary mapping stage names to their count, total, mean
+        and maximum durations in seconds
+        """
+        stages = dict()
+        with self.lock:
+            for e in self.events:
+                s = stages.setdefault(e['name'], {'count': 0, 'total': 0.,
+                                                  'max': 0.})
+                s['count'] += 1
+                s['total'] += e['dur'] / 1e6
+                s['max'] = max(s['max'], e['dur'] / 1e6)
+        for s in stages.values():
+            s['mean'] = s['total'] / s['count']
+        return stages
+
+    def printsummary(self):
+        """
+        Display the time spent in each stage, slowest first. Nested stages
+        are included in the time of their parent and stages running in
+        several threads can add up to more than the wall time.
+        """
+        wall = time.perf_counter() - self.origin
+        stages = self.summary()
+        print('{:24s} {:>7s} {:>10s} {:>10s} {:>10s} {:>7s}'.format(
+            'stage', 'count', 'total', 'mean', 'max', 'wall'))
+        for name in sorted(stages, key=lambda n: -stages[n]['total']):
+            s = stages[name]
+            print('{:24s} {:7d} {:9.3f}s {:9.4f}s {:9.4f}s {:6.1f}%'.format(
+                name[:24], s['count'], s['total'], s['mean'], s['max'],
+                100. * s['total'] / wall if wall > 0 else 0.))
+        print('Wall time: {:.3f}s'.format(wall))
+
+
+class NullTracer:
+    """
+    Tracer doing nothing, used when tracing is disabled
+    """
+    def span(self, name, **args):
+        return contextlib.nullcontext()
+
+    def iterate(self, iterable, name):
+        return iterable
+
+    def save(self, filename):
+        pass
+
+    def printsummary(self):
+        pass
+
+
+NULL_TRACER = NullTracer()
+
+
+def gettracer(enabled):
+    """
+    :param enabled: whether the spans are recorded
+    :return: Tracer object if enabled, NULL_TRACER otherwise
+    """
+    return Tracer() if enabled else NULL_TRACER
@@ -1,17 +1,25 @@
 #
-from nipype.interfaces.fsl import Slicer
-from nipype.interfaces.fsl import SwapDimensions
+# pyxnat, nipype, PIL and requests are imported where they are needed so
+# that the script starts quickly, e.g. when no snapshot is generated
 import xml.etree.ElementTree as ET
 import os.path as path
-import pyxnat as xnat
-from PIL import Image
+from adni_discovery import discoverscans, findscaninfofiles
+from nifti_index import rendersnapshot
+from file_stream import CHUNK_SIZE, GzipChunks
+from pipeline_trace import NULL_TRACER, gettracer
 import tempfile
 import argparse
-import urllib3
-import glob
+import hashlib
+import socket
+import zlib
+import json
+import time
+import sys
 import os
 
-urllib3.disable_warnings()
+# Upload bandwidth in bytes per second assumed by the plan estimate when it
+# is neither given nor measured
+DEFAULT_BANDWIDTH = 10e6
 
 
 def getinterface(url, user, passwd):
@@ -23,6 +31,9 @@ def getinterface(url, user, passwd):
     :param passwd: xnat password as a string
     "return: pyxnat interface object
     """
+    import pyxnat as xnat
+    import urllib3
+    urllib3.disable_warnings()
     # Remove the last '/' to avoid requests issue
     if url.endswith('/'):
         url = url[:-1]
@@ -35,14 +46,24 @@ def getinterface(url, user, passwd):
         intf._exec('/data/JSESSION', method='DELETE')
     except:
         raise ValueError('Unable to connect to XNAT')
-    else:
-        try:
-            intf.manage.schemas.add('schemas/xnat.xsd')
-        except:
-            raise ValueError('Unable to download XNAT schema')
     return intf
 
 
+def loadschema(intf):
+    """
+    Download the XNAT schema the first time it is needed rather than when
+    connecting, a dry run never loading it
+    :param intf: pyxnat interface object
+    """
+    if getattr(intf, 'schema_loaded', False):
+        return
+    try:
+        intf.manage.schemas.add('schemas/xnat.xsd')
+    except:
+        raise ValueError('Unable to download XNAT schema')
+    intf.schema_loaded = True
+
+
 def getscaninfo(scan_info_file):
     """
     Extract the metadata information from the provide xml file
@@ -117,6 +138,778 @@ def getscaninfo(scan_info_file):
     return scan_info
 
 
+def getscanid(scan_file):
+    """
+    Extract the ADNI image identifier from a nifti filename
+    :param scan_file: nifti filename
+    :return: string containing the image identifier, e.g. I12345
+    """
+    name = path.basename(scan_file).removesuffix('.gz').removesuffix('.nii')
+    return name.split('_')[-1]
+
+
+def isduplicate(scan_file, seen):
+    """
+    Check whether another file of the run has the same image identifier,
+    e.g. X.nii next to X.nii.gz, which would create the scan twice. The
+    compressed copy is preferred when both are in the same folder.
+    :param scan_file: nifti filename
+    :param seen: dictionary mapping the image identifiers already processed
+    to their filename, updated with this file
+    :return: True if the file should be skipped
+    """
+    if scan_file.endswith('.nii') and path.exists(scan_file + '.gz'):
+        return True
+    scan_id = getscanid(scan_file)
+    if scan_id in seen:
+        return True
+    seen[scan_id] = scan_file
+    return False
+
+
+def getscaninfofile(scan_info_files, scan_id):
+    """
+    Find the xml file describing a scan
+    :param scan_info_files: dictionary returned by findscaninfofiles
+    :param scan_id: ADNI image identifier
+    :return: list containing the xml filename
+    """
+    scan_info_file = scan_info_files.get(scan_id, [])
+    if not len(scan_info_file) == 1:
+        raise ValueError('To many info file for scan ' + scan_id)
+    return scan_info_file
+
+
+def filedigest(filename, hash_cache):
+    """
+    Compute the md5 digest of a file, reusing the cached value when the file
+    size and modification time did not change
+    :param filename: file to hash
+    :param hash_cache: dictionary mapping filenames to their size, mtime and
+    digest, updated in place
+    :return: md5 digest as an hexadecimal string
+    """
+    stat = os.stat(filename)
+    cached = hash_cache.get(filename)
+    if cached is not None and cached[0] == stat.st_size and \
+            cached[1] == stat.st_mtime_ns:
+        return cached[2]
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    hash_cache[filename] = [stat.st_size, stat.st_mtime_ns, md5.hexdigest()]
+    return hash_cache[filename][2]
+
+
+def compresseddigest(filename, hash_cache):
+    """
+    Compute the size and md5 digest of the gzip file uploaded for an
+    uncompressed file with --compress, reusing the cached values when the
+    file size and modification time did not change
+    :param filename: uncompressed file
+    :param hash_cache: dictionary used by filedigest, updated in place
+    :return: tuple containing the compressed size and its md5 digest
+    """
+    stat = os.stat(filename)
+    key = filename + ':gzip'
+    cached = hash_cache.get(key)
+    if cached is not None and cached[0] == stat.st_size and \
+            cached[1] == stat.st_mtime_ns:
+        return cached[3], cached[2]
+    md5 = hashlib.md5()
+    size = 0
+    for chunk in GzipChunks(filename):
+        md5.update(chunk)
+        size += len(chunk)
+    hash_cache[key] = [stat.st_size, stat.st_mtime_ns, md5.hexdigest(), size]
+    return size, md5.hexdigest()
+
+
+def iscompressed(filename, compress):
+    """
+    Check whether a file is gzipped on the fly when uploaded
+    :param filename: local filename
+    :param compress: --compress option
+    :return: True for uncompressed nifti files when compress is set
+    """
+    return compress and filename.endswith('.nii')
+
+
+def getremotename(filename, compress=False):
+    """
+    :param filename: local filename
+    :param compress: --compress option
+    :return: name of the file on XNAT
+    """
+    name = path.basename(filename)
+    return name + '.gz' if iscompressed(filename, compress) else name
+
+
+def getremotefiles(scan, remote=None):
+    """
+    List the files of the NIFTI resource of a scan with the size and digest
+    reported by XNAT
+    :param scan: pyxnat scan object
+    :param remote: dictionary returned by prefetchremote, can be None
+    :return: dictionary mapping filenames to their size and digest
+    """
+    if remote is not None and scan._uri in remote['files']:
+        files = remote['files'][scan._uri]
+    else:
+        content = scan._intf._exec(scan._uri + '/files?format=json',
+                                   method='GET')
+        files = json.loads(content)['ResultSet']['Result']
+    remote_files = dict()
+    for f in files:
+        if f.get('collection', 'NIFTI') == 'NIFTI':
+            remote_files[f['Name']] = {'size': int(f['Size']),
+                                       'digest': f.get('digest', '')}
+    return remote_files
+
+
+def objectexists(xnat_object, remote=None):
+    """
+    Check whether an XNAT object exists, using the prefetched answer when
+    available
+    :param xnat_object: pyxnat subject, experiment or scan object
+    :param remote: dictionary returned by prefetchremote, can be None
+    :return: True if the object exists
+    """
+    if remote is not None and xnat_object._uri in remote['exists']:
+        return remote['exists'][xnat_object._uri]
+    return xnat_object.exists()
+
+
+def prefetchremote(transport, project, batch, sync=False):
+    """
+    Check concurrently which subjects, experiments and scans of a batch of
+    local scans already exist on XNAT and, for the sync mode, list the files
+    of the existing scans
+    :param transport: XNATTransport object
+    :param project: pyxnat project object
+    :param batch: list of (scan_file, scan_info_file, scan_info) tuples
+    :param sync: also retrieve the file listings of existing scans
+    :return: dictionary with the existence of each object and the file
+    listings, both indexed by uri
+    """
+    uris = []
+    scan_uris = []
+    for scan_file, scan_info_file, scan_info in batch:
+        subject = project.subject(scan_info['subject_id'])
+        experiment = subject.experiment(scan_info['subject_id'] + '_' +
+                                        scan_info['session_id'])
+        scan = experiment.scan(str(getscanid(scan_file)[1:]))
+        uris += [subject._uri, experiment._uri, scan._uri]
+        scan_uris.append(scan._uri)
+    remote = {'exists': transport.exists(list(set(uris))), 'files': dict()}
+    if sync:
+        remote['files'] = transport.listfiles(
+            [u for u in set(scan_uris) if remote['exists'][u]])
+    return remote
+
+
+def filechanged(filename, remote_file, hash_cache, compress=False):
+    """
+    Check whether a local file differs from its copy on XNAT. The size is
+    compared first and the digest only when XNAT reports one.
+    :param filename: local filename
+    :param remote_file: dictionary with the remote size and digest, None if
+    the file is not on XNAT
+    :param hash_cache: dictionary used by filedigest
+    :param compress: the file is gzipped on the fly when uploaded, so the
+    remote copy is compared with the compressed output
+    :return: True if the file has to be uploaded
+    """
+    if remote_file is None:
+        return True
+    if iscompressed(filename, compress):
+        size, digest = compresseddigest(filename, hash_cache)
+        return size != remote_file['size'] or \
+            (remote_file['digest'] != '' and digest != remote_file['digest'])
+    if path.getsize(filename) != remote_file['size']:
+        return True
+    if remote_file['digest'] == '':
+        return False
+    return filedigest(filename, hash_cache) != remote_file['digest']
+
+
+def diffscan(project, scan_file, scan_info_file, scan_info, planned=None,
+             hash_cache=None, remote=None, compress=False):
+    """
+    Compare a local scan with the remote project and list what needs to be
+    created or uploaded, without writing anything on XNAT
+    :param project: pyxnat project object
+    :param scan_file: nifti filename
+    :param scan_info_file: list containing the xml filename
+    :param scan_info: dictionary containing scan metadata
+    :param planned: dictionary with the sets of subjects and experiments
+    already scheduled for creation by previous scans of the same plan or run
+    :param hash_cache: dictionary used by filedigest. When provided, the
+    files of existing scans are compared with their remote copies and only
+    the new or changed ones are uploaded
+    :param remote: dictionary returned by prefetchremote, can be None
+    :param compress: uncompressed nifti files are gzipped on the fly when
+    uploaded
+    :return: dictionary describing the actions, None if the scan exists and
+    is not synchronised
+    """
+    if planned is None:
+        planned = {'subjects': set(), 'experiments': set()}
+    scan_id = getscanid(scan_file)
+    experiment_label = scan_info['subject_id'] + '_' + scan_info['session_id']
+
+    subject = project.subject(scan_info['subject_id'])
+    experiment = subject.experiment(experiment_label)
+    scan = experiment.scan(str(scan_id[1:]))
+
+    # Objects scheduled for creation earlier in the plan do not exist yet,
+    # so there is no need to query XNAT about them or their children
+    subject_new = scan_info['subject_id'] in planned['subjects']
+    experiment_new = subject_new or experiment_label in planned['experiments']
+    upload_files = [[scan_file, 'NII', 'PROCESSED'],
+                    [scan_info_file[0], 'XML', None]]
+    if not experiment_new and objectexists(scan, remote):
+        if hash_cache is None:
+            return None
+        remote_files = getremotefiles(scan, remote)
+        changed = [f for f in upload_files
+                   if filechanged(f[0], remote_files.get(
+                       getremotename(f[0], compress)), hash_cache, compress)]
+        return {'scan_file': scan_file,
+                'scan_info_file': scan_info_file[0],
+                'scan_id': scan_id,
+                'scan_info': scan_info,
+                'create_subject': False,
+                'create_experiment': False,
+                'create_scan': False,
+                'overwrite': True,
+                'compress': compress,
+                'upload_files': changed,
+                'upload_bytes': sum(path.getsize(f[0]) for f in changed),
+                'skipped_bytes': sum(path.getsize(f[0]) for f in upload_files
+                                     if f not in changed),
+                # A new image makes the previous snapshot obsolete
+                'snapshot': scan_file in [f[0] for f in changed]}
+
+    create_subject = not subject_new and not objectexists(subject, remote)
+    if create_subject:
+        planned['subjects'].add(scan_info['subject_id'])
+    create_experiment = experiment_label not in planned['experiments'] and \
+        (subject_new or create_subject or
+         not objectexists(experiment, remote))
+    if create_experiment:
+        planned['experiments'].add(experiment_label)
+
+    # A new scan has no resources yet, so everything has to be uploaded
+    return {'scan_file': scan_file,
+            'scan_info_file': scan_info_file[0],
+            'scan_id': scan_id,
+            'scan_info': scan_info,
+            'create_subject': create_subject,
+            'create_experiment': create_experiment,
+            'create_scan': True,
+            'overwrite': False,
+            'compress': compress,
+            'upload_files': upload_files,
+            'upload_bytes': sum(path.getsize(f[0]) for f in upload_files),
+            'skipped_bytes': 0,
+            'snapshot': True}
+
+
+def getbatches(items, size):
+    """
+    Group the items of an iterable in lists
+    :param items: iterable
+    :param size: number of items per list
+    :return: generator of lists
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def hasactions(action):
+    """
+    Check whether diffscan found anything to do for a scan
+    :param action: dictionary returned by diffscan
+    :return: True if something has to be created or uploaded
+    """
+    return action['create_scan'] or len(action['upload_files']) > 0 or \
+        action['snapshot']
+
+
+def planaction(action):
+    """
+    Make the paths of an action absolute, so that a saved plan can be
+    executed from any working directory
+    :param action: dictionary returned by diffscan
+    :return: copy of the action with absolute paths
+    """
+    action = dict(action)
+    action['scan_file'] = path.abspath(action['scan_file'])
+    action['scan_info_file'] = path.abspath(action['scan_info_file'])
+    action['upload_files'] = [[path.abspath(f[0])] + f[1:]
+                              for f in action['upload_files']]
+    return action
+
+
+def createsubject(subject, scan_info):
+    """
+    Create a subject on XNAT and set its meta-data
+    :param subject: pyxnat subject object
+    :param scan_info: dictionary containing scan metadata
+    """
+    print('Subject started ' + scan_info['subject_id'])
+    subject.insert()
+    subject.attrs.mset({
+        'xnat:subjectData/fields/field[name=apoe1]/field':
+            scan_info['APOEA1'],
+        'xnat:subjectData/fields/field[name=apoe2]/field':
+            scan_info['APOEA2'],
+        'xnat:subjectData/demographics'
+        '[@xsi:type=xnat:demographicData]/gender': scan_info['gender']
+    })
+    print('Subject created ' + scan_info['subject_id'])
+
+
+def createexperiment(experiment, scan_info):
+    """
+    Create a mrSessionData experiment on XNAT and set its meta-data
+    :param experiment: pyxnat experiment object
+    :param scan_info: dictionary containing scan metadata
+    """
+    print('Session started ' +
+          scan_info['subject_id'] + '_' + scan_info['session_id'])
+    experiment.insert(**{
+        'experiments': 'xnat:mrSessionData',
+        'xnat:mrSessionData/date': scan_info['date'],
+        'xnat:mrSessionData/age': scan_info['age'],
+        'xnat:mrSessionData/acquisition_site': scan_info['site'],
+        'xnat:mrSessionData/scanner/manufacturer':
+            scan_info['manufacturer'],
+        'xnat:mrSessionData/scanner':
+            scan_info['manufacturer'] + '_' + scan_info['scanner'],
+        'xnat:mrSessionData/scanner/model': scan_info['scanner'],
+        'xnat:mrSessionData/modality': scan_info['modality'],
+        'xnat:mrSessionData/fieldStrength': scan_info['fieldStrength'],
+        'xnat:mrSessionData/coil': scan_info['coil'],
+        'xnat:mrSessionData/session_type': scan_info['visittype'],
+    })
+    experiment.attrs.mset({
+        'xnat:mrSessionData/fields/field[name=visittype]/field':
+            scan_info['visittype'],
+        'xnat:mrSessionData/fields/field[name=clinicalgroup]/field':
+            scan_info['clinicalgroup'],
+        'xnat:mrSessionData/fields/field[name=mmse]/field':
+            scan_info['mmse'],
+        'xnat:mrSessionData/fields/field[name=cdr]/field':
+            scan_info['cdr'],
+        'xnat:mrSessionData/fields/field[name=gds]/field':
+            scan_info['gds'],
+        'xnat:mrSessionData/fields/field[name=faq]/field':
+            scan_info['faq'],
+        'xnat:mrSessionData/fields/field[name=npi]/field':
+            scan_info['npi'],
+    })
+    print('Session created ' +
+          scan_info['subject_id'] + '_' + scan_info['session_id'])
+
+
+def createscan(scan, scan_info, scan_id):
+    """
+    Create a mrScanData scan on XNAT and set its meta-data
+    :param scan: pyxnat scan object
+    :param scan_info: dictionary containing scan metadata
+    :param scan_id: ADNI image identifier
+    """
+    print('Scan started ' + scan_id[1:])
+    scan.insert(**{
+        'scans': 'xnat:mrScanData',
+        'xnat:mrScanData/type': scan_info['type'],
+        'xnat:mrScanData/series_description':
+            scan_info['series_description'],
+        'xnat:mrScanData/scanner/manufacturer':
+            scan_info['manufacturer'],
+        'xnat:mrScanData/scanner/model': scan_info['scanner'],
+        'xnat:mrScanData/modality': scan_info['modality'],
+        'xnat:mrScanData/fieldStrength': scan_info['fieldStrength'],
+        'xnat:mrScanData/parameters/tr': scan_info['tr'],
+        'xnat:mrScanData/parameters/ti': scan_info['ti'],
+        'xnat:mrScanData/parameters/te': scan_info['te'],
+        'xnat:mrScanData/parameters/flip': scan_info['flip'],
+        'xnat:mrSessionData/coil': scan_info['coil'],
+        'xnat:mrScanData/parameters/scanSequence':
+            scan_info['scanSequence'],
+        'xnat:mrScanData/parameters/voxelRes/units': 'mm',
+        'xnat:mrScanData/parameters/voxelRes/x': scan_info['resx'],
+        'xnat:mrScanData/parameters/voxelRes/y': scan_info['resy'],
+        'xnat:mrScanData/parameters/voxelRes/z': scan_info['resz'],
+        'xnat:mrScanData/parameters/matrix/x': scan_info['nx'],
+        'xnat:mrScanData/parameters/matrix/y': scan_info['ny'],
+        'xnat:mrScanData/frames': int(float(scan_info['nz'])),
+        'xnat:mrScanData/parameters/acqType': scan_info['acqType'],
+    })
+    print('Scan created ' + scan_id[1:])
+
+
+def parseshard(value):
+    """
+    Parse the --shard argument
+    :param value: string i/N, the shard index i being between 0 and N-1
+    :return: tuple containing the shard index and the number of shards
+    """
+    try:
+        index, shards = [int(v) for v in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected i/N, got ' + value)
+    if shards < 1 or not 0 <= index < shards:
+        raise argparse.ArgumentTypeError('expected 0 <= i < N, got ' + value)
+    return index, shards
+
+
+def getshard(subject, shards):
+    """
+    Assign a subject to a shard. md5 is used rather than hash, which is
+    randomised per process, so that every process and host agrees.
+    :param subject: subject folder name
+    :param shards: number of shards
+    :return: shard index
+    """
+    return int(hashlib.md5(subject.encode()).hexdigest(), 16) % shards
+
+
+def getscankey(scan_file):
+    """
+    Identify a scan independently of where the ADNI folder is mounted
+    :param scan_file: nifti filename
+    :return: path relative to the parent of the ADNI folder, e.g.
+    ADNI/<subject>/<description>/<date>/<image>/<file>
+    """
+    return '/'.join(path.normpath(path.abspath(scan_file)).split(os.sep)[-6:])
+
+
+def loadjournal(journal_file):
+    """
+    Read the scans completed by previous runs
+    :param journal_file: json lines filename, can be None
+    :return: set of scan keys
+    """
+    completed = set()
+    if journal_file is None or not path.exists(journal_file):
+        return completed
+    with open(journal_file) as f:
+        for line in f:
+            try:
+                completed.add(json.loads(line)['scan'])
+            except (ValueError, KeyError):
+                # The last line is truncated if the process was killed
+                continue
+    return completed
+
+
+def recordscan(journal, scan_file, status, shard, action=None):
+    """
+    Append a completed scan to the journal
+    :param journal: file object opened in append mode, can be None
+    :param scan_file: nifti filename
+    :param status: 'uploaded' or 'unchanged'
+    :param shard: tuple containing the shard index and the number of shards
+    :param action: dictionary returned by diffscan for uploaded scans
+    """
+    if journal is None:
+        return
+    entry = {'scan': getscankey(scan_file),
+             'status': status,
+             'shard': '{}/{}'.format(*shard),
+             'bytes': 0 if action is None else action['upload_bytes'],
+             'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+    journal.write(json.dumps(entry) + '\n')
+    # Flush every line so that a killed run loses at most one scan
+    journal.flush()
+
+
+def addsummary(total, actions):
+    """
+    Add the counts of some actions to a running summary
+    :param total: dictionary returned by summariseplan, updated in place
+    :param actions: list of dictionaries returned by diffscan
+    """
+    for k, v in summariseplan(actions).items():
+        total[k] += v
+
+
+def renderslicer(scan_file, filename_swap, filename_snap,
+                 tracer=NULL_TRACER):
+    """
+    Render the middle slices of a scan with fslswapdim and slicer
+    :param scan_file: nifti filename
+    :param filename_swap: temporary filename for the reoriented image
+    :param filename_snap: png filename
+    :param tracer: pipeline_trace tracer recording each command
+    """
+    from nipype.interfaces.fsl import Slicer
+    from nipype.interfaces.fsl import SwapDimensions
+    swapdim = SwapDimensions(command='fsl5.0-fslswapdim')
+    swapdim.inputs.new_dims = ('LR', 'PA', 'IS')
+    swapdim.inputs.in_file = scan_file
+    swapdim.inputs.out_file = filename_swap
+    with tracer.span('snapshot fslswapdim'):
+        swapdim.run()
+
+    slicer_snap = Slicer(command='fsl5.0-slicer')
+    slicer_snap.inputs.in_file = filename_swap
+    slicer_snap.inputs.out_file = filename_snap
+    slicer_snap.inputs.middle_slices = True
+    with tracer.span('snapshot slicer'):
+        slicer_snap.run()
+
+
+def createsnapshot(snap, scan_file, scan_info, scan_id, overwrite=False,
+                   snapshot_method='index', tracer=NULL_TRACER):
+    """
+    Render the middle slices of a scan and upload them, together with a
+    thumbnail, in the SNAPSHOTS resource
+    :param snap: pyxnat resource object
+    :param scan_file: nifti filename
+    :param scan_info: dictionary containing scan metadata
+    :param scan_id: ADNI image identifier
+    :param overwrite: replace the existing snapshot files
+    :param snapshot_method: 'index' to read the middle slices directly from
+    the compressed file, falling back to 'fsl' (fslswapdim and slicer) for
+    images it cannot read
+    :param tracer: pipeline_trace tracer recording the rendering and upload
+    """
+    from PIL import Image
+    prefix = tempfile.gettempdir() + os.sep + \
+        scan_info['subject_id'] + '_' + \
+        scan_info['session_id'] + '_' + scan_id[1:]
+    filename_swap = prefix + '._s.nii.gz'
+    filename_snap = prefix + '.png'
+    filename_thumb = prefix + '_t.png'
+
+    try:
+        if snapshot_method == 'index':
+            try:
+                with tracer.span('snapshot index'):
+                    rendersnapshot(scan_file, filename_snap)
+            except (ValueError, EOFError, zlib.error):
+                renderslicer(scan_file, filename_swap, filename_snap, tracer)
+        else:
+            renderslicer(scan_file, filename_swap, filename_snap, tracer)
+
+        with tracer.span('snapshot put'):
+            snap.file(path.basename(filename_snap)).put(
+                filename_snap, 'PNG', 'ORIGINAL', overwrite=overwrite)
+        with tracer.span('snapshot thumbnail'):
+            thumbnail = Image.open(filename_snap)
+            thumbnail.thumbnail((300, 300))
+            thumbnail.save(filename_thumb)
+        with tracer.span('snapshot put'):
+            snap.file(path.basename(filename_thumb)).put(
+                filename_thumb, 'PNG', 'THUMBNAIL', overwrite=overwrite)
+    except:
+        pass
+    for f in [filename_swap, filename_snap, filename_thumb]:
+        if path.exists(f):
+            os.remove(f)
+
+
+def executescan(project, action, snapshot_method='index',
+                tracer=NULL_TRACER, transport=None, chunk_size=CHUNK_SIZE):
+    """
+    Apply the actions computed by diffscan for a single scan
+    :param project: pyxnat project object
+    :param action: dictionary describing the actions to perform
+    :param snapshot_method: method used by createsnapshot
+    :param tracer: pipeline_trace tracer recording each step
+    :param transport: XNATTransport object streaming the files from disk,
+    None to upload them with pyxnat
+    :param chunk_size: size of the blocks read from disk when streaming
+    :return: number of bytes sent for the files, smaller than
+    action['upload_bytes'] when they are compressed on the fly
+    """
+    compress = action.get('compress', False)
+    if compress and transport is None:
+        raise ValueError('Files can only be compressed when streamed')
+    scan_info = action['scan_info']
+    scan_id = action['scan_id']
+    subject = project.subject(scan_info['subject_id'])
+    experiment = subject.experiment(scan_info['subject_id'] + '_' +
+                                    scan_info['session_id'])
+    scan = experiment.scan(str(scan_id[1:]))
+
+    if action['create_subject'] or action['create_experiment'] or \
+            action['create_scan']:
+        with tracer.span('schema'):
+            loadschema(project._intf)
+    if action['create_subject']:
+        with tracer.span('create subject', scan=scan_id):
+            createsubject(subject, scan_info)
+    if action['create_experiment']:
+        with tracer.span('create experiment', scan=scan_id):
+            createexperiment(experiment, scan_info)
+    if action['create_scan']:
+        with tracer.span('create scan', scan=scan_id):
+            createscan(scan, scan_info, scan_id)
+
+    # Upload the data
+    sent_bytes = 0
+    if transport is not None and len(action['upload_files']) > 0:
+        # Stream the files from disk, the resource being created first as
+        # pyxnat does implicitly
+        resource_uri = scan._uri + '/resources/NIFTI'
+        with tracer.span('resource create', scan=scan_id):
+            transport.createresources([resource_uri])
+        files = []
+        for filename, file_format, file_content in action['upload_files']:
+            params = {'format': file_format}
+            if file_content is not None:
+                params['content'] = file_content
+            if action['overwrite']:
+                params['overwrite'] = 'true'
+            files.append((resource_uri + '/files/' +
+                          getremotename(filename, compress),
+                          filename, params, chunk_size,
+                          iscompressed(filename, compress)))
+        with tracer.span('file put', scan=scan_id, files=len(files)):
+            sent_bytes = sum(transport.upload(files))
+    else:
+        for filename, file_format, file_content in action['upload_files']:
+            with tracer.span('file put', scan=scan_id,
+                             file=path.basename(filename)):
+                if file_content is None:
+                    scan.resource('NIFTI').file(path.basename(filename)).put(
+                        filename, file_format, overwrite=action['overwrite'])
+                else:
+                    scan.resource('NIFTI').file(path.basename(filename)).put(
+                        filename, file_format, file_content,
+                        overwrite=action['overwrite'])
+            sent_bytes += path.getsize(filename)
+    if len(action['upload_files']) > 0:
+        print('Data uploaded ' + action['scan_file'])
+
+    # Create a snapshot
+    if action['snapshot']:
+        with tracer.span('snapshot', scan=scan_id):
+            createsnapshot(scan.resource('SNAPSHOTS'), action['scan_file'],
+                           scan_info, scan_id, overwrite=action['overwrite'],
+                           snapshot_method=snapshot_method, tracer=tracer)
+    return sent_bytes
+
+
+def measurelatency(intf, repeat=5):
+    """
+    Measure the mean duration of a small XNAT request
+    :param intf: pyxnat interface object
+    :param repeat: number of requests to average
+    :return: latency in seconds
+    """
+    start = time.time()
+    for _ in range(repeat):
+        intf._exec('/data/JSESSION', method='GET')
+    return (time.time() - start) / repeat
+
+
+def measurebandwidth(intf, project_id, latency=0., size=8 << 20):
+    """
+    Measure the upload rate by sending a scratch file to a temporary
+    resource of the project, which is deleted afterwards
+    :param intf: pyxnat interface object
+    :param project_id: xnat project id, the user needs write access
+    :param latency: request latency in seconds, subtracted from the upload
+    time as it is counted separately in the estimate
+    :param size: size of the scratch file in bytes
+    :return: bandwidth in bytes per second
+    """
+    resource_uri = '/data/projects/{}/resources/BANDWIDTH_{}'.format(
+        project_id, os.urandom(4).hex())
+    # Random bytes so that a compressing proxy does not inflate the rate
+    body = os.urandom(size)
+    intf._exec(resource_uri, method='PUT')
+    try:
+        start = time.time()
+        intf._exec(resource_uri + '/files/probe.bin?inbody=true',
+                   method='PUT', body=body,
+                   headers={'Content-Type': 'application/octet-stream'})
+        elapsed = time.time() - start
+    finally:
+        intf._exec(resource_uri + '?removeFiles=true', method='DELETE')
+    return size / max(elapsed - latency, 1e-6)
+
+
+def summariseplan(scans):
+    """
+    Count the objects, files and bytes a plan will create or upload
+    :param scans: list of dictionaries returned by diffscan
+    :return: dictionary containing the totals
+    """
+    return {'subjects': sum(s['create_subject'] for s in scans),
+            'experiments': sum(s['create_experiment'] for s in scans),
+            'scans': sum(s['create_scan'] for s in scans),
+            'files': sum(len(s['upload_files']) for s in scans),
+            'bytes': sum(s['upload_bytes'] for s in scans),
+            'skipped_bytes': sum(s['skipped_bytes'] for s in scans),
+            'snapshots': sum(s['snapshot'] for s in scans)}
+
+
+def estimateduration(summary, latency, bandwidth, snapshot_time):
+    """
+    Estimate how long a plan will take to execute
+    :param summary: dictionary returned by summariseplan
+    :param latency: request latency in seconds
+    :param bandwidth: upload bandwidth in bytes per second
+    :param snapshot_time: time to render a snapshot in seconds
+    :return: dictionary containing the estimated durations in seconds
+    """
+    # Creating a subject or an experiment implies an insert and a mset call,
+    # every snapshot uploads a full size image and a thumbnail
+    requests_number = 2 * summary['subjects'] + \
+        2 * summary['experiments'] + \
+        summary['scans'] + \
+        summary['files'] + \
+        2 * summary['snapshots']
+    estimate = {'latency': latency,
+                'bandwidth': bandwidth,
+                'requests': requests_number,
+                'requests_time': requests_number * latency,
+                'transfer_time': summary['bytes'] / bandwidth,
+                'snapshots_time': summary['snapshots'] * snapshot_time}
+    estimate['total_time'] = estimate['requests_time'] + \
+        estimate['transfer_time'] + estimate['snapshots_time']
+    return estimate
+
+
+def printplan(plan):
+    """
+    Display the summary of an upload plan
+    :param plan: dictionary describing the upload plan
+    """
+    summary = plan['summary']
+    estimate = plan['estimate']
+    print('Subjects to create: {}'.format(summary['subjects']))
+    print('Experiments to create: {}'.format(summary['experiments']))
+    print('Scans to create: {}'.format(summary['scans']))
+    print('Files to upload: {} ({:.1f} MB)'.format(summary['files'],
+                                                  summary['bytes'] / 1e6))
+    print('Unchanged data skipped: {:.1f} MB'.format(
+        summary['skipped_bytes'] / 1e6))
+    print('Snapshots to render: {}'.format(summary['snapshots']))
+    print('Measured latency: {:.3f}s, {} bandwidth: {:.2f} MB/s'.format(
+        estimate['latency'], estimate.get('bandwidth_source', 'given'),
+        estimate['bandwidth'] / 1e6))
+    print('Estimated duration: {:.0f}s ({:.0f}s requests, {:.0f}s transfer, '
+          '{:.0f}s snapshots)'.format(estimate['total_time'],
+                                      estimate['requests_time'],
+                                      estimate['transfer_time'],
+                                      estimate['snapshots_time']))
+
+
 if __name__ == '__main__':
     # Parser to set default values for xnat url and credentials
     parser = argparse.ArgumentParser()
@@ -130,8 +923,10 @@ if __name__ == '__main__':
                         help='Default XNAT password',
                         type=str)
     parser.add_argument('input_path',
-                        help='Path to the folder containing the ADNI data',
-                        type=str)
+                        help='Path to the folder containing the ADNI data, '
+                             'not required with --execute-plan',
+                        type=str,
+                        nargs='?')
     parser.add_argument('-p', '--project',
                         help='XNAT project where the data will be uploaded',
                         type=str,
@@ -140,181 +935,330 @@ if __name__ == '__main__':
                         help='Default path to save files',
                         type=str,
                         default=tempfile.gettempdir())
+    parser.add_argument('--plan',
+                        help='Compute the upload plan without writing '
+                             'anything on XNAT and save it in this file',
+                        type=str)
+    parser.add_argument('--execute-plan',
+                        help='Execute a plan previously saved with --plan',
+                        type=str)
+    parser.add_argument('--bandwidth',
+                        help='Upload bandwidth in MB/s used for the plan '
+                             'estimate, a rough default of {:.0f} MB/s is '
+                             'assumed otherwise'.format(
+                                 DEFAULT_BANDWIDTH / 1e6),
+                        type=float)
+    parser.add_argument('--measure-bandwidth',
+                        help='Measure the bandwidth of the plan estimate by '
+                             'uploading a scratch file to a temporary '
+                             'project resource, deleted right after. This '
+                             'writes to XNAT and needs write access.',
+                        action='store_true')
+    parser.add_argument('--snapshot-time',
+                        help='Time in seconds to render a snapshot, used for '
+                             'the plan estimate',
+                        type=float,
+                        default=5.)
+    parser.add_argument('--snapshot-method',
+                        help='Read the middle slices directly from the '
+                             'compressed image (index) or use fslswapdim '
+                             'and slicer (fsl)',
+                        choices=['index', 'fsl'],
+                        default='index')
+    parser.add_argument('--discovery-cache',
+                        help='File caching the directory mtimes so that '
+                             'only modified folders are listed again, use '
+                             'one file per shard',
+                        type=str)
+    parser.add_argument('--sync',
+                        help='Compare the files of existing scans with their '
+                             'remote copies and upload the new or changed '
+                             'ones',
+                        action='store_true')
+    parser.add_argument('--hash-cache',
+                        help='File caching the local md5 digests by path, '
+                             'size and mtime, used with --sync',
+                        type=str)
+    parser.add_argument('--concurrency',
+                        help='Maximum number of simultaneous metadata '
+                             'requests',
+                        type=int,
+                        default=16)
+    parser.add_argument('--batch-size',
+                        help='Number of scans whose existence on XNAT is '
+                             'checked concurrently',
+                        type=int,
+                        default=32)
+    parser.add_argument('--discovery-workers',
+                        help='Number of subject folders listed in parallel',
+                        type=int,
+                        default=8)
+    parser.add_argument('--shard',
+                        help='Only process the subjects of shard i out of N '
+                             '(0 <= i < N), so that N processes or hosts can '
+                             'upload the same ADNI folder concurrently',
+                        type=parseshard,
+                        default=(0, 1))
+    parser.add_argument('--journal',
+                        help='File recording the completed scans, which are '
+                             'skipped when running again',
+                        type=str)
+    parser.add_argument('--report',
+                        help='Save the counts and duration of this run in '
+                             'this json file, see merge_upload_shards.py',
+                        type=str)
+    parser.add_argument('--upload-method',
+                        help='Stream the files from disk in fixed-size '
+                             'blocks (stream) or upload them with pyxnat',
+                        choices=['stream', 'pyxnat'],
+                        default='stream')
+    parser.add_argument('--chunk-size',
+                        help='Size in MB of the blocks read from disk when '
+                             'streaming',
+                        type=float,
+                        default=CHUNK_SIZE / 1e6)
+    parser.add_argument('--compress',
+                        help='Also upload the uncompressed nifti files '
+                             '(.nii), gzipped while streaming them and '
+                             'stored as .nii.gz',
+                        action='store_true')
+    parser.add_argument('--trace',
+                        help='Record the duration of each stage of each '
+                             'scan in this Chrome trace file (open it in '
+                             'chrome://tracing or ui.perfetto.dev) and '
+                             'print a summary per stage',
+                        type=str)
     args = parser.parse_args()
+    if args.plan and args.execute_plan:
+        parser.error('--plan and --execute-plan are mutually exclusive')
+    if args.input_path is None and args.execute_plan is None:
+        parser.error('input_path is required')
+    if args.compress and args.upload_method != 'stream':
+        parser.error('--compress requires --upload-method stream')
+    chunk_size = max(1, int(args.chunk_size * 1e6))
+
+    tracer = gettracer(args.trace is not None)
+
+    def savetrace():
+        if args.trace is None:
+            return
+        tracer.save(args.trace)
+        tracer.printsummary()
+        print('Trace saved in ' + args.trace)
 
     # # Check the xnat credentials
-    intf = getinterface(args.xnat_url,
-                        args.xnat_user,
-                        args.xnat_pwd)
-
-    # Check all the locally available scans
-    all_scans = glob.glob(
-        '/'.join([args.input_path, 'ADNI', '*', '*', '*', '*', '*.nii.gz']))
-    if len(all_scans) == 0:
-        raise ValueError('No Nifti files in the specified path')
-    else:
-        print('Number of nifti files: {}'.format(len(all_scans)))
+    with tracer.span('connect'):
+        intf = getinterface(args.xnat_url,
+                            args.xnat_user,
+                            args.xnat_pwd)
+
+    shard_index, shards = args.shard
+    completed = loadjournal(args.journal)
+    journal = None
+    if args.journal is not None and not args.plan:
+        journal = open(args.journal, 'a')
+
+    def inshard(subject):
+        return getshard(subject, shards) == shard_index
+
+    report = {'shard': [shard_index, shards],
+              'host': socket.gethostname(),
+              'project': args.project,
+              'input_path': args.input_path,
+              'mode': 'plan' if args.plan else 'upload',
+              'started': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'scans': 0,
+              'journal_skipped': 0,
+              'unchanged': 0,
+              'sent_bytes': 0,
+              'summary': summariseplan([])}
+    start = time.time()
+
+    def printsent(compressed):
+        if compressed and not args.plan:
+            print('Compression saved {:.1f} MB ({:.1f} MB sent)'.format(
+                (report['summary']['bytes'] - report['sent_bytes']) / 1e6,
+                report['sent_bytes'] / 1e6))
+
+    def savereport():
+        if args.report is None:
+            return
+        report['finished'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        report['duration'] = time.time() - start
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    if args.execute_plan:
+        # Read the plan rather than rediscovering the local files
+        with open(args.execute_plan) as f:
+            plan = json.load(f)
+        report['project'] = plan['project']
+        report['input_path'] = plan['input_path']
+        # Checked before anything is created on XNAT
+        compressed = any(a.get('compress', False) for a in plan['scans'])
+        if compressed and args.upload_method != 'stream':
+            parser.error('the plan was made with --compress, which requires '
+                         '--upload-method stream')
+        print('Number of scans in the plan: {}'.format(len(plan['scans'])))
+        project = intf.select.project(plan['project'])
+        stream_transport = None
+        if args.upload_method == 'stream':
+            from xnat_async import XNATTransport
+            stream_transport = XNATTransport(args.xnat_url, args.xnat_user,
+                                             args.xnat_pwd,
+                                             concurrency=args.concurrency)
+        for action in plan['scans']:
+            scan_key = getscankey(action['scan_file'])
+            if not inshard(scan_key.split('/')[1]):
+                continue
+            report['scans'] += 1
+            if scan_key in completed:
+                report['journal_skipped'] += 1
+                continue
+            report['sent_bytes'] += executescan(
+                project, action, args.snapshot_method, tracer,
+                stream_transport, chunk_size)
+            addsummary(report['summary'], [action])
+            recordscan(journal, action['scan_file'], 'uploaded', args.shard,
+                       action)
+        if stream_transport is not None:
+            stream_transport.close()
+        printsent(compressed)
+        intf.disconnect()
+        if journal is not None:
+            journal.close()
+        savereport()
+        savetrace()
+        sys.exit(0)
 
     # Connect to the ADNI project
     project = intf.select.project(args.project)
 
-    # Iterate over all scan files
-    for scan_file in all_scans:
+    # Iterate over the locally available scans as they are discovered
+    with tracer.span('xml discovery'):
+        scan_info_files = findscaninfofiles(args.input_path)
+    scan_number = 0
+    planned = {'subjects': set(), 'experiments': set()}
+    plan_scans = []
+    hash_cache = None
+    if args.sync:
+        hash_cache = dict()
+        if args.hash_cache is not None and path.exists(args.hash_cache):
+            with open(args.hash_cache) as f:
+                hash_cache = json.load(f)
+    skipped_bytes = 0
+    from xnat_async import XNATTransport
+    transport = XNATTransport(args.xnat_url, args.xnat_user, args.xnat_pwd,
+                              concurrency=args.concurrency)
+    # Subjects of other shards are not even listed
+    all_scans = discoverscans(args.input_path,
+                              cache_file=args.discovery_cache,
+                              workers=args.discovery_workers,
+                              suffixes=('.nii.gz', '.nii') if args.compress
+                              else ('.nii.gz',),
+                              select=inshard if shards > 1 else None)
+    seen_ids = dict()
+    try:
+        for batch_files in tracer.iterate(getbatches(all_scans,
+                                                     args.batch_size),
+                                          'discovery'):
 
-        # Extract the metadata information
-        scan_id = path.basename(scan_file).removesuffix(
-            '.nii.gz').split('_')[-1]
-        scan_info_file = glob.glob(
-            '/'.join([args.input_path, 'ADNI', '*' + scan_id + '.xml']))
-        if not len(scan_info_file) == 1:
-            raise ValueError('To many info file for scan ' + scan_id)
-        scan_info = getscaninfo(scan_info_file)
+            # Extract the metadata information
+            batch = []
+            for scan_file in batch_files:
+                scan_number += 1
+                if isduplicate(scan_file, seen_ids):
+                    print('Skipping {}, its image identifier was already '
+                          'found'.format(scan_file))
+                    continue
+                if getscankey(scan_file) in completed:
+                    report['journal_skipped'] += 1
+                    continue
+                scan_info_file = getscaninfofile(scan_info_files,
+                                                 getscanid(scan_file))
+                with tracer.span('xml parse', scan=getscanid(scan_file)):
+                    batch.append((scan_file, scan_info_file,
+                                  getscaninfo(scan_info_file)))
 
-        # Create the subject on xnat if needed
-        subject = project.subject(scan_info['subject_id'])
-        experiment = subject.experiment(scan_info['subject_id'] + '_' +
-                                        scan_info['session_id'])
-        scan = experiment.scan(str(scan_id[1:]))
-
-        if scan.exists():
-            continue
-
-        if not subject.exists():
-            print('Subject started ' + scan_info['subject_id'])
-            subject.insert()
-            subject.attrs.mset({
-                'xnat:subjectData/fields/field[name=apoe1]/field':
-                    scan_info['APOEA1'],
-                'xnat:subjectData/fields/field[name=apoe2]/field':
-                    scan_info['APOEA2'],
-                'xnat:subjectData/demographics'
-                '[@xsi:type=xnat:demographicData]/gender': scan_info['gender']
-            })
-            print('Subject created ' + scan_info['subject_id'])
-
-        # Create the experiment on xnat if needed
-        if not experiment.exists():
-            print('Session started ' +
-                  scan_info['subject_id'] + '_' + scan_info['session_id'])
-            experiment.insert(**{
-                'experiments': 'xnat:mrSessionData',
-                'xnat:mrSessionData/date': scan_info['date'],
-                'xnat:mrSessionData/age': scan_info['age'],
-                'xnat:mrSessionData/acquisition_site': scan_info['site'],
-                'xnat:mrSessionData/scanner/manufacturer':
-                    scan_info['manufacturer'],
-                'xnat:mrSessionData/scanner':
-                    scan_info['manufacturer'] + '_' + scan_info['scanner'],
-                'xnat:mrSessionData/scanner/model': scan_info['scanner'],
-                'xnat:mrSessionData/modality': scan_info['modality'],
-                'xnat:mrSessionData/fieldStrength': scan_info['fieldStrength'],
-                'xnat:mrSessionData/coil': scan_info['coil'],
-                'xnat:mrSessionData/session_type': scan_info['visittype'],
-            })
-            experiment.attrs.mset({
-                'xnat:mrSessionData/fields/field[name=visittype]/field':
-                    scan_info['visittype'],
-                'xnat:mrSessionData/fields/field[name=clinicalgroup]/field':
-                    scan_info['clinicalgroup'],
-                'xnat:mrSessionData/fields/field[name=mmse]/field':
-                    scan_info['mmse'],
-                'xnat:mrSessionData/fields/field[name=cdr]/field':
-                    scan_info['cdr'],
-                'xnat:mrSessionData/fields/field[name=gds]/field':
-                    scan_info['gds'],
-                'xnat:mrSessionData/fields/field[name=faq]/field':
-                    scan_info['faq'],
-                'xnat:mrSessionData/fields/field[name=npi]/field':
-                    scan_info['npi'],
-            })
-            print('Session created ' +
-                  scan_info['subject_id'] + '_' + scan_info['session_id'])
-
-        # Create the scan on xnat if needed
-        scan = experiment.scan(str(scan_id[1:]))
-        if scan.exists() is False:
-            print('Scan started ' + scan_id[1:])
-            scan.insert(**{
-                'scans': 'xnat:mrScanData',
-                'xnat:mrScanData/type': scan_info['type'],
-                'xnat:mrScanData/series_description':
-                    scan_info['series_description'],
-                'xnat:mrScanData/scanner/manufacturer':
-                    scan_info['manufacturer'],
-                'xnat:mrScanData/scanner/model': scan_info['scanner'],
-                'xnat:mrScanData/modality': scan_info['modality'],
-                'xnat:mrScanData/fieldStrength': scan_info['fieldStrength'],
-                'xnat:mrScanData/parameters/tr': scan_info['tr'],
-                'xnat:mrScanData/parameters/ti': scan_info['ti'],
-                'xnat:mrScanData/parameters/te': scan_info['te'],
-                'xnat:mrScanData/parameters/flip': scan_info['flip'],
-                'xnat:mrSessionData/coil': scan_info['coil'],
-                'xnat:mrScanData/parameters/scanSequence':
-                    scan_info['scanSequence'],
-                'xnat:mrScanData/parameters/voxelRes/units': 'mm',
-                'xnat:mrScanData/parameters/voxelRes/x': scan_info['resx'],
-                'xnat:mrScanData/parameters/voxelRes/y': scan_info['resy'],
-                'xnat:mrScanData/parameters/voxelRes/z': scan_info['resz'],
-                'xnat:mrScanData/parameters/matrix/x': scan_info['nx'],
-                'xnat:mrScanData/parameters/matrix/y': scan_info['ny'],
-                'xnat:mrScanData/frames': int(float(scan_info['nz'])),
-                'xnat:mrScanData/parameters/acqType': scan_info['acqType'],
-            })
-            print('Scan created ' + scan_id[1:])
-
-        # Upload the data
-        nii = scan.resource('NIFTI')
-        if not nii.exists():
-            scan.resource('NIFTI').file(path.basename(scan_file)).put(
-                scan_file, 'NII', 'PROCESSED')
-            scan.resource('NIFTI').file(path.basename(scan_info_file[0])).put(
-                scan_info_file[0], 'XML')
-            print('Data uploaded ' + scan_file)
-
-        # Create a snapshot
-
-        snap = scan.resource('SNAPSHOTS')
-        if not snap.exists():
-
-            filename_swap = tempfile.gettempdir() + os.sep + \
-                            scan_info['subject_id'] + '_' + \
-                            scan_info['session_id'] + '_' + \
-                            scan_id[1:] + '._s.nii.gz'
-            filename_snap = tempfile.gettempdir() + os.sep + \
-                            scan_info['subject_id'] + '_' + \
-                            scan_info['session_id'] + '_' + \
-                            scan_id[1:] + '.png'
-            filename_thumb = tempfile.gettempdir() + os.sep + \
-                             scan_info['subject_id'] + '_' + \
-                             scan_info['session_id'] + '_' + \
-                             scan_id[1:] + '_t.png'
-
-            swapdim = SwapDimensions(command='fsl5.0-fslswapdim')
-            slicer_snap = Slicer(command='fsl5.0-slicer')
+            # Compare with the remote project, the existence checks of the
+            # whole batch being sent concurrently
+            with tracer.span('remote check', scans=len(batch)):
+                remote = prefetchremote(transport, project, batch, args.sync)
+            for scan_file, scan_info_file, scan_info in batch:
+                with tracer.span('diff', scan=getscanid(scan_file)):
+                    action = diffscan(project, scan_file, scan_info_file,
+                                      scan_info, planned, hash_cache, remote,
+                                      args.compress)
+                if action is not None:
+                    skipped_bytes += action['skipped_bytes']
+                if action is None or not hasactions(action):
+                    report['unchanged'] += 1
+                    recordscan(journal, scan_file, 'unchanged', args.shard)
+                    continue
 
+                if args.plan:
+                    plan_scans.append(planaction(action))
+                else:
+                    report['sent_bytes'] += executescan(
+                        project, action, args.snapshot_method, tracer,
+                        transport if args.upload_method == 'stream' else None,
+                        chunk_size)
+                    recordscan(journal, scan_file, 'uploaded', args.shard,
+                               action)
+                addsummary(report['summary'], [action])
+    finally:
+        # Stop the discovery threads at once if anything failed
+        all_scans.close()
+    transport.close()
+    if journal is not None:
+        journal.close()
+    report['scans'] = scan_number
+    report['summary']['skipped_bytes'] = skipped_bytes
+
+    if scan_number == 0 and shards == 1:
+        raise ValueError('No Nifti files in the specified path')
+    else:
+        print('Number of nifti files: {}'.format(scan_number))
+    printsent(args.compress)
+    if args.sync:
+        print('Unchanged data skipped: {:.1f} MB'.format(skipped_bytes / 1e6))
+        if args.hash_cache is not None:
+            with open(args.hash_cache, 'w') as f:
+                json.dump(hash_cache, f)
+
+    if args.plan:
+        summary = summariseplan(plan_scans)
+        # Scans without any change are not part of the plan
+        summary['skipped_bytes'] = skipped_bytes
+        latency = measurelatency(intf)
+        if args.bandwidth is not None:
+            bandwidth, bandwidth_source = args.bandwidth * 1e6, 'given'
+        else:
+            bandwidth, bandwidth_source = DEFAULT_BANDWIDTH, 'assumed'
+        if args.measure_bandwidth:
             try:
-                swapdim.inputs.new_dims = ('LR', 'PA', 'IS')
-                swapdim.inputs.in_file = scan_file
-                swapdim.inputs.out_file = filename_swap
-                swapdim.run()
-
-                slicer_snap.inputs.in_file = filename_swap
-                slicer_snap.inputs.out_file = filename_snap
-                slicer_snap.inputs.middle_slices = True
-                slicer_snap.run()
-
-                snap.file(path.basename(filename_snap)).put(
-                    filename_snap, 'PNG', 'ORIGINAL')
-                thumbnail = Image.open(filename_snap)
-                thumbnail.thumbnail((300, 300))
-                thumbnail.save(filename_thumb)
-                snap.file(path.basename(filename_thumb)).put(
-                    filename_thumb, 'PNG', 'THUMBNAIL')
-            except:
-                pass
-            os.remove(swapdim.inputs.out_file)
-            os.remove(filename_snap)
-            os.remove(filename_thumb)
+                bandwidth = measurebandwidth(intf, args.project, latency)
+                bandwidth_source = 'measured'
+            except Exception as e:
+                # The plan is still worth saving with the fallback value
+                print('Unable to measure the bandwidth ({}), using {:.2f} '
+                      'MB/s'.format(e, bandwidth / 1e6))
+        plan = {'project': args.project,
+                'input_path': path.abspath(args.input_path),
+                'shard': [shard_index, shards],
+                'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'summary': summary,
+                'estimate': estimateduration(summary, latency, bandwidth,
+                                             args.snapshot_time),
+                'scans': plan_scans}
+        plan['estimate']['bandwidth_source'] = bandwidth_source
+        with open(args.plan, 'w') as f:
+            json.dump(plan, f, indent=1)
+        printplan(plan)
+        print('Plan saved in ' + args.plan)
+
+    savereport()
+    savetrace()
 
     # Disconnect the xnat interface
     intf.disconnect()
@@ -1,16 +1,33 @@
 from PyQt5 import QtWidgets, QtCore
-from PyQt5.QtGui import QPixmap
-import pyxnat as xnat
+from PyQt5.QtGui import QPixmap, QIcon
+from xnat_mirror import openmirror, getsubjects, getmrsessions, getfiles
+from pipeline_trace import NULL_TRACER, gettracer
 import argparse
-import requests
+import threading
 import tempfile
-import urllib3
 import glob
 import time
 import sys
 import os
 
-urllib3.disable_warnings()
+# pyxnat and requests are imported once the login window is displayed, and
+# the XNAT schema is only downloaded when a search needs it
+
+
+def loadschema(interface, parent):
+    """
+    Download the XNAT schema the first time it is needed
+    :param interface: pyxnat interface object
+    :param parent: widget used to display a warning on failure
+    """
+    if getattr(interface, 'schema_loaded', False):
+        return
+    try:
+        interface.manage.schemas.add('schemas/xnat.xsd')
+    except:
+        QtWidgets.QMessageBox.warning(
+            parent, 'Error', 'Unable to download the XNAT schemas')
+    interface.schema_loaded = True
 
 
 class XNATLogin(QtWidgets.QDialog):
@@ -21,7 +38,8 @@ class XNATLogin(QtWidgets.QDialog):
                  parent=None,
                  xnat_server='',
                  username='',
-                 password=''
+                 password='',
+                 tracer=NULL_TRACER
                  ):
         """
 
@@ -29,8 +47,10 @@ class XNATLogin(QtWidgets.QDialog):
         :param xnat_server: Default value to use for the xnat server url
         :param username: Default username
         :param password: Default password
+        :param tracer: pipeline_trace tracer recording the login
         """
         super(XNATLogin, self).__init__(parent)
+        self.tracer = tracer
         # Dialog for xnat server input
         promptServer = QtWidgets.QLabel(self)
         promptServer.setText('XNAT Server URL:')
@@ -69,6 +89,9 @@ class XNATLogin(QtWidgets.QDialog):
         Check whether the provided url and credential are functional
         :return:
         """
+        import pyxnat as xnat
+        import urllib3
+        urllib3.disable_warnings()
         # remove the trailing '/' if needed
         if self.textServer.text().endswith('/'):
             self.textServer.setText(self.textServer.text()[:-1])
@@ -81,16 +104,12 @@ class XNATLogin(QtWidgets.QDialog):
                                         verify=False,
                                         anonymous=anonymous)
         try:
-            self.interface._exec('/data/JSESSION', method='DELETE')
+            with self.tracer.span('login'):
+                self.interface._exec('/data/JSESSION', method='DELETE')
         except:
             QtWidgets.QMessageBox.warning(
                 self, 'Error', 'Unable to connect to XNAT')
         else:
-            try:
-                self.interface.manage.schemas.add('schemas/xnat.xsd')
-            except:
-                QtWidgets.QMessageBox.warning(
-                    self, 'Error', 'Unable to download the XNAT schemas')
             self.accept()
             self.interface.disconnect()
 
@@ -108,10 +127,16 @@ class XNATSelectProjectPatient(QtWidgets.QDialog):
     """
     def __init__(self,
                  parent=None,
-                 interface=None):
+                 interface=None,
+                 mirror=None,
+                 tracer=NULL_TRACER):
         super(XNATSelectProjectPatient, self).__init__(parent)
 
-        self.retrievexnatinfo(interface)
+        with tracer.span('subject list'):
+            if mirror is not None:
+                self.subject_data = getsubjects(mirror)
+            else:
+                self.retrievexnatinfo(interface)
 
         promptProject = QtWidgets.QLabel(self)
         promptProject.setText('Select the XNAT project')
@@ -142,6 +167,7 @@ class XNATSelectProjectPatient(QtWidgets.QDialog):
         keys and the patients are the associated values
         :param interface: pyxnat interface object
         """
+        loadschema(interface, self)
         raw_data = interface.select('xnat:subjectData').all()
         interface.disconnect()
         self.subject_data = {}
@@ -186,6 +212,280 @@ class XNATSelectProjectPatient(QtWidgets.QDialog):
         return self.boxSubject.currentText()
 
 
+def getthumbnails(files):
+    """
+    Select the thumbnail of each scan in the files of a SNAPSHOTS resource
+    :param files: list of dictionaries with the URI, Name and file_content
+    of each file, as in the XNAT listing
+    :return: dictionary mapping scan ids to the URI of their thumbnail
+    """
+    thumbnails = dict()
+    for f in files:
+        if f.get('file_content') != 'THUMBNAIL' and \
+                not f['Name'].endswith('_t.png'):
+            continue
+        scan_id = f['URI'].split('/scans/')[1].split('/')[0]
+        thumbnails.setdefault(scan_id, f['URI'])
+    return thumbnails
+
+
+class ThumbnailSignals(QtCore.QObject):
+    """
+    Signals used by the thumbnail loaders to send their results to the
+    window, QRunnable not being a QObject
+    """
+    listed = QtCore.pyqtSignal(str, object)
+    loaded = QtCore.pyqtSignal(str, str, object)
+
+
+class ThumbnailListLoader(QtCore.QRunnable):
+    """
+    List the thumbnails of a session in a worker thread
+    """
+    def __init__(self, session, server, session_id, signals,
+                 tracer=NULL_TRACER):
+        """
+        :param session: requests session object
+        :param server: xnat url as a string
+        :param session_id: xnat experiment id
+        :param signals: ThumbnailSignals object
+        :param tracer: pipeline_trace tracer recording the request
+        """
+        super(ThumbnailListLoader, self).__init__()
+        self.session = session
+        self.server = server
+        self.session_id = session_id
+        self.signals = signals
+        self.tracer = tracer
+
+    def run(self):
+        files = []
+        try:
+            with self.tracer.span('thumbnail list', session=self.session_id):
+                r = self.session.get(self.server + '/data/experiments/' +
+                                     self.session_id +
+                                     '/scans/ALL/resources/SNAPSHOTS/files',
+                                     params={'format': 'json'}, timeout=30)
+            if r.status_code == 200:
+                files = r.json()['ResultSet']['Result']
+            r.close()
+        except:
+            pass
+        self.signals.listed.emit(self.session_id, getthumbnails(files))
+
+
+class ThumbnailLoader(QtCore.QRunnable):
+    """
+    Download a thumbnail in a worker thread
+    """
+    def __init__(self, session, server, session_id, scan_id, uri, signals,
+                 tracer=NULL_TRACER):
+        """
+        :param session: requests session object
+        :param server: xnat url as a string
+        :param session_id: xnat experiment id
+        :param scan_id: xnat scan id
+        :param uri: path of the thumbnail file
+        :param signals: ThumbnailSignals object
+        :param tracer: pipeline_trace tracer recording the download
+        """
+        super(ThumbnailLoader, self).__init__()
+        self.session = session
+        self.server = server
+        self.session_id = session_id
+        self.scan_id = scan_id
+        self.uri = uri
+        self.signals = signals
+        self.tracer = tracer
+
+    def run(self):
+        data = b''
+        try:
+            with self.tracer.span('thumbnail download',
+                                  session=self.session_id,
+                                  scan=self.scan_id):
+                r = self.session.get(self.server + self.uri, timeout=30)
+            if r.status_code == 200:
+                data = r.content
+            r.close()
+        except:
+            pass
+        self.signals.loaded.emit(self.session_id, self.scan_id, data)
+
+
+def finishdownloads(pool, session):
+    """
+    Wait for the downloads of a closed thumbnail grid and close its
+    connections, meant to run outside the GUI thread
+    :param pool: QThreadPool object running the downloads
+    :param session: requests session object
+    """
+    pool.waitForDone()
+    session.close()
+
+
+class ThumbnailGridWindow(QtWidgets.QDialog):
+    """
+    Dialog displaying the thumbnails of all the scans of one or several
+    sessions. The small THUMBNAIL files created by upload_adni_data.py are
+    downloaded concurrently and displayed as they arrive; clicking one
+    selects the scan in the main window, which fetches the full snapshot.
+    """
+    scanSelected = QtCore.pyqtSignal(str, str)
+
+    def __init__(self,
+                 parent=None,
+                 interface=None,
+                 mr_sessions=None,
+                 session_ids=None,
+                 mirror=None,
+                 concurrency=8,
+                 columns=6,
+                 tracer=NULL_TRACER):
+        """
+        :param parent:
+        :param interface: pyxnat interface object
+        :param mr_sessions: dictionary describing the sessions and scans,
+        as built by ScanDisplayAndSaveWindow
+        :param session_ids: list of the xnat experiment ids to display
+        :param mirror: sqlite3 connection to a local mirror of the project,
+        used instead of XNAT to list the thumbnails
+        :param concurrency: number of thumbnails downloaded at once
+        :param columns: number of thumbnails per row
+        :param tracer: pipeline_trace tracer recording the downloads
+        """
+        super(ThumbnailGridWindow, self).__init__(parent)
+        import requests
+        from requests.adapters import HTTPAdapter
+        # A new grid is opened each time, free it with its thread pool and
+        # connections once closed
+        self.setAttribute(QtCore.Qt.WA_DeleteOnClose)
+        self.setWindowTitle('Thumbnails')
+        self.thumbSize = 150
+        self.server = interface._server
+        self.session = requests.session()
+        if interface._user:
+            self.session.auth = (interface._user, interface._pwd)
+        self.session.verify = False
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # Not owned by the dialog, whose deletion would otherwise wait for
+        # the downloads in progress on the GUI thread
+        self.pool = QtCore.QThreadPool()
+        self.closing = False
+        self.pool.setMaxThreadCount(concurrency)
+        self.tracer = tracer
+        self.signals = ThumbnailSignals()
+        self.signals.listed.connect(self.handleListed)
+        self.signals.loaded.connect(self.handleLoaded)
+
+        # One row of headers and thumbnail buttons per session, created
+        # before anything is downloaded so that the layout does not move
+        grid = QtWidgets.QWidget()
+        layout = QtWidgets.QGridLayout(grid)
+        self.buttons = dict()
+        row = 0
+        for session_id in session_ids:
+            header = QtWidgets.QLabel(mr_sessions[session_id]['label'] +
+                                      ' - ' + mr_sessions[session_id]['date'])
+            layout.addWidget(header, row, 0, 1, columns)
+            row += 1
+            for n, scan_id in enumerate(mr_sessions[session_id]['scanIds']):
+                button = QtWidgets.QToolButton(grid)
+                button.setToolButtonStyle(QtCore.Qt.ToolButtonTextUnderIcon)
+                button.setIconSize(QtCore.QSize(self.thumbSize,
+                                                self.thumbSize))
+                button.setFixedSize(self.thumbSize + 10, self.thumbSize + 30)
+                button.setText(scan_id + ' - ' +
+                               mr_sessions[session_id][scan_id]['type'])
+                button.setToolTip('Loading...')
+                button.clicked.connect(
+                    lambda checked, e=session_id, s=scan_id:
+                    self.scanSelected.emit(e, s))
+                layout.addWidget(button, row + n // columns, n % columns)
+                self.buttons[(session_id, scan_id)] = button
+            row += max(1, (len(mr_sessions[session_id]['scanIds']) +
+                           columns - 1) // columns)
+        scroll = QtWidgets.QScrollArea(self)
+        scroll.setWidget(grid)
+        scroll.setWidgetResizable(True)
+
+        buttonClose = QtWidgets.QPushButton('Close', self)
+        buttonClose.clicked.connect(self.reject)
+
+        windowLayout = QtWidgets.QVBoxLayout(self)
+        windowLayout.addWidget(scroll)
+        windowLayout.addWidget(buttonClose)
+        self.resize(columns * (self.thumbSize + 16) + 40, 600)
+
+        for session_id in session_ids:
+            if mirror is not None:
+                self.handleListed(session_id, getthumbnails(
+                    getfiles(mirror, session_id, 'SNAPSHOTS')))
+            else:
+                self.pool.start(ThumbnailListLoader(
+                    self.session, self.server, session_id, self.signals,
+                    self.tracer))
+
+    def handleListed(self, session_id, thumbnails):
+        """
+        Start downloading the thumbnails of a session once listed
+        :param session_id: xnat experiment id
+        :param thumbnails: dictionary mapping scan ids to thumbnail URIs
+        """
+        if self.closing:
+            return
+        for (e, scan_id), button in self.buttons.items():
+            if e != session_id:
+                continue
+            if scan_id in thumbnails:
+                self.pool.start(ThumbnailLoader(
+                    self.session, self.server, session_id, scan_id,
+                    thumbnails[scan_id], self.signals, self.tracer))
+            else:
+                button.setToolTip('No thumbnail')
+
+    def handleLoaded(self, session_id, scan_id, data):
+        """
+        Display a downloaded thumbnail
+        :param session_id: xnat experiment id
+        :param scan_id: xnat scan id
+        :param data: content of the png file, empty if it failed
+        """
+        if self.closing:
+            return
+        button = self.buttons[(session_id, scan_id)]
+        pixmap = QPixmap()
+        if len(data) == 0 or not pixmap.loadFromData(data):
+            button.setToolTip('Unable to retrieve the thumbnail')
+            return
+        button.setIcon(QIcon(pixmap.scaled(self.thumbSize, self.thumbSize,
+                                           QtCore.Qt.KeepAspectRatio)))
+        button.setToolTip('')
+
+    def done(self, result):
+        """
+        Drop the pending downloads and close the connections without
+        blocking the viewer. Closing the window, the Close button and Esc
+        all end up here.
+        """
+        if not self.closing:
+            self.closing = True
+            self.signals.listed.disconnect()
+            self.signals.loaded.disconnect()
+            self.pool.clear()
+            # Downloads in progress can take up to their timeout, they
+            # finish in the background before the connections are closed
+            threading.Thread(target=finishdownloads,
+                             args=(self.pool, self.session),
+                             daemon=True).start()
+            self.pool = None
+        super(ThumbnailGridWindow, self).done(result)
+        # Esc hides the dialog without a close event
+        self.deleteLater()
+
+
 class ScanDisplayAndSaveWindow(QtWidgets.QDialog):
     """
     Dialog to display snapshot for selected scan
@@ -195,66 +495,36 @@ class ScanDisplayAndSaveWindow(QtWidgets.QDialog):
                  interface=None,
                  project=None,
                  subject=None,
-                 output_path=''):
+                 output_path='',
+                 mirror=None,
+                 tracer=NULL_TRACER):
         """
         Main dialog to select and display scan snapshots
         :param parent:
         :param interface: pyxnat interface object
         :param project: string containing the xnat project id
         :param subject: string containing the xnat subject id
+        :param output_path: default folder where files are saved
+        :param mirror: sqlite3 connection to a local mirror of the project,
+        used instead of XNAT to list the sessions and scans
+        :param tracer: pipeline_trace tracer recording the requests
         """
         super(ScanDisplayAndSaveWindow, self).__init__(parent)
-        # Retrieve a list of all xnat:mrSessionData type
-        all_mr_sessions = interface.inspect.field_values(
-            'xnat:mrSessionData/SESSION_ID')
+        self.tracer = tracer
         self.intf = interface
         self.proj = project
         self.subj = subject
         self.out = output_path
-        # Extract a list of all experiments that are xnat:mrSessionData
-        # for the selected subject
-        experiment_ids = [e for e in self.intf.select.project(
-            project).subject(subject).experiments().get()
-                          if e in all_mr_sessions]
-        if len(experiment_ids) == 0:
+        self.mirror = mirror
+        with tracer.span('session list'):
+            if mirror is not None:
+                self.mr_sessions = getmrsessions(mirror, project, subject)
+            else:
+                self.retrievesessions(project, subject)
+        if len(self.mr_sessions) == 0:
             QtWidgets.QMessageBox.warning(
                 self, 'Error', 'This patient does not have any mrSessionData')
             self.close()
-        # Store metadata information about all scans of all xnat:mrSessionData
-        # into a dictionary. Moved to a requests call rather than pyxnat as to
-        # limit the number of rest call and thus gain time
-        self.mr_sessions = dict()
-        reqSession = requests.session()
-        for e in experiment_ids:
-            url = self.intf._server + '/data/experiments/' + e + '?format=json'
-            r = reqSession.get(url,
-                               verify=False,
-                               auth=(self.intf._user,
-                                     self.intf._pwd))
-            exp_json = r.json()
-            # Extract some session information
-            label = exp_json['items'][0]['data_fields']['label']
-            date = exp_json['items'][0]['data_fields']['date']
-
-            self.mr_sessions[e] = {'label': label,
-                                   'date': date,
-                                   'scanIds': []}
-
-            # Iterate through children to find the scans
-            for c in exp_json['items'][0]['children']:
-                if c['field'] == 'scans/scan':
-                    for s in c['items']:
-                        scan_quality = s['data_fields']['quality']
-                        scan_id = s['data_fields']['ID']
-                        scan_type = s['data_fields']['type']
-
-                        if not scan_id == '99':
-                            self.mr_sessions[e]['scanIds'].append(scan_id)
-                            self.mr_sessions[e][scan_id] = {
-                                'type': scan_type,
-                                'quality': scan_quality
-                            }
-        reqSession.close()
 
         # Create dialogs to select the session and display related
         # information
@@ -286,6 +556,16 @@ class ScanDisplayAndSaveWindow(QtWidgets.QDialog):
         self.promptFilename = QtWidgets.QLabel(self)
         self.textFilename = QtWidgets.QLineEdit(self)
 
+        # Create buttons to display the thumbnails of all the scans
+        buttonSessionThumbs = QtWidgets.QPushButton(
+            'Session thumbnails', self)
+        buttonSessionThumbs.clicked.connect(
+            lambda: self.handleThumbnails(False))
+        buttonSubjectThumbs = QtWidgets.QPushButton(
+            'Subject thumbnails', self)
+        buttonSubjectThumbs.clicked.connect(
+            lambda: self.handleThumbnails(True))
+
         # Create a button to save the file
         buttonSave = QtWidgets.QPushButton('Save file', self)
         buttonSave.clicked.connect(self.handleSave)
@@ -305,6 +585,10 @@ class ScanDisplayAndSaveWindow(QtWidgets.QDialog):
         layout.addWidget(self.scanType)
         layout.addWidget(self.scanQuality)
         layout.addWidget(self.boxImage)
+        thumbsLayout = QtWidgets.QHBoxLayout()
+        thumbsLayout.addWidget(buttonSessionThumbs)
+        thumbsLayout.addWidget(buttonSubjectThumbs)
+        layout.addLayout(thumbsLayout)
 
         layout.addWidget(promptType)
         layout.addWidget(self.boxType)
@@ -318,6 +602,95 @@ class ScanDisplayAndSaveWindow(QtWidgets.QDialog):
 
         self.start = time.time()
 
+    def retrievesessions(self, project, subject):
+        """
+        Retrieve from XNAT the sessions and scans of the selected subject
+        :param project: string containing the xnat project id
+        :param subject: string containing the xnat subject id
+        """
+        from xnat_async import XNATTransport
+        loadschema(self.intf, self)
+        # Retrieve a list of all xnat:mrSessionData type
+        all_mr_sessions = self.intf.inspect.field_values(
+            'xnat:mrSessionData/SESSION_ID')
+        # Extract a list of all experiments that are xnat:mrSessionData
+        # for the selected subject
+        with self.tracer.span('experiment list'):
+            experiment_ids = [e for e in self.intf.select.project(
+                project).subject(subject).experiments().get()
+                              if e in all_mr_sessions]
+        # Store metadata information about all scans of all xnat:mrSessionData
+        # into a dictionary. Moved to a requests call rather than pyxnat as to
+        # limit the number of rest call and thus gain time, the experiments
+        # being retrieved concurrently
+        self.mr_sessions = dict()
+        transport = XNATTransport.frominterface(self.intf)
+        with self.tracer.span('experiment documents',
+                              experiments=len(experiment_ids)):
+            experiments = transport.getexperiments(experiment_ids)
+        transport.close()
+        for e in experiment_ids:
+            exp_json = experiments[e]
+            # Extract some session information
+            label = exp_json['data_fields']['label']
+            date = exp_json['data_fields']['date']
+
+            self.mr_sessions[e] = {'label': label,
+                                   'date': date,
+                                   'scanIds': []}
+
+            # Iterate through children to find the scans
+            for c in exp_json['children']:
+                if c['field'] == 'scans/scan':
+                    for s in c['items']:
+                        scan_quality = s['data_fields']['quality']
+                        scan_id = s['data_fields']['ID']
+                        scan_type = s['data_fields']['type']
+
+                        if not scan_id == '99':
+                            self.mr_sessions[e]['scanIds'].append(scan_id)
+                            self.mr_sessions[e][scan_id] = {
+                                'type': scan_type,
+                                'quality': scan_quality
+                            }
+
+    def handleThumbnails(self, all_sessions):
+        """
+        Open a grid with the thumbnails of the selected session or of all
+        the sessions of the subject
+        :param all_sessions: display all the sessions of the subject
+        """
+        if all_sessions:
+            session_ids = sorted(self.mr_sessions.keys())
+        else:
+            session_ids = [self.getCurrentSessionId()]
+        grid = ThumbnailGridWindow(self,
+                                   interface=self.intf,
+                                   mr_sessions=self.mr_sessions,
+                                   session_ids=session_ids,
+                                   mirror=self.mirror,
+                                   tracer=self.tracer)
+        grid.scanSelected.connect(self.selectScan)
+        grid.show()
+
+    def selectScan(self, session_id, scan_id):
+        """
+        Select a scan in the combo boxes, which displays its snapshot
+        :param session_id: xnat experiment id
+        :param scan_id: xnat scan id
+        """
+        # Do not retrieve the snapshot of the first scan of the session
+        # while the scan list is updated
+        self.boxScan.blockSignals(True)
+        self.boxSession.setCurrentIndex(
+            self.boxSession.findText(self.mr_sessions[session_id]['label']))
+        self.boxScan.blockSignals(False)
+        index = self.mr_sessions[session_id]['scanIds'].index(scan_id)
+        if self.boxScan.currentIndex() == index:
+            self.updateScanDetails()
+        else:
+            self.boxScan.setCurrentIndex(index)
+
     def handleClose(self):
         """
         Display the time spent on this window,
@@ -408,10 +781,13 @@ class ScanDisplayAndSaveWindow(QtWidgets.QDialog):
         self.boxType.clear()
         scan = self.intf.select.experiment(session_id).scan(scan_id)
         no_file = True
-        if scan.resource('NIFTI').exists():
+        with self.tracer.span('resource check', scan=scan_id):
+            has_nifti = scan.resource('NIFTI').exists()
+            has_dicom = scan.resource('DICOM').exists()
+        if has_nifti:
             no_file = False
             self.boxType.addItem('NIFTI')
-        if scan.resource('DICOM').exists():
+        if has_dicom:
             no_file = False
             self.boxType.addItem('DICOM')
         if no_file:
@@ -424,7 +800,9 @@ class ScanDisplayAndSaveWindow(QtWidgets.QDialog):
         # downloaded
         img_filename = tempfile.gettempdir() + os.sep +\
                        'img_' + session_id + '_' + scan_id + '.gif'
+        pixmap = QPixmap(img_filename)
         if not os.path.exists(img_filename):
+            import requests
             # Here used direclty the rest call as did not manage with pyxnat
             url = [self.intf._server + '/xapi/experiments/' + session_id + \
                    '/scan/' + scan_id + '/snapshot/3X3',
@@ -432,10 +810,11 @@ class ScanDisplayAndSaveWindow(QtWidgets.QDialog):
                    '/scan/' + scan_id + '/snapshot']
             for u in url:
                 print('Retrieve snapshot: ' + u)
-                r = requests.get(u,
-                                 verify=False,
-                                 auth=(self.intf._user,
-                                       self.intf._pwd))
+                with self.tracer.span('snapshot download', scan=scan_id):
+                    r = requests.get(u,
+                                     verify=False,
+                                     auth=(self.intf._user,
+                                           self.intf._pwd))
                 with open(img_filename, 'wb') as f:
                     f.write(r.content)
                 r.close()
@@ -493,18 +872,34 @@ if __name__ == '__main__':
                         help='Default path to save files',
                         type=str,
                         default=tempfile.gettempdir())
+    parser.add_argument('-m', '--mirror',
+                        help='Local mirror created with xnat_mirror.py, used '
+                             'to list projects, subjects, sessions and scans',
+                        type=str)
+    parser.add_argument('--trace',
+                        help='Record the duration of the requests in this '
+                             'Chrome trace file and print a summary per '
+                             'stage on exit',
+                        type=str)
     args = parser.parse_args()
+    tracer = gettracer(args.trace is not None)
+    mirror = None
+    if args.mirror is not None:
+        mirror = openmirror(args.mirror)
 
     app = QtWidgets.QApplication(sys.argv)
 
     login = XNATLogin(xnat_server=args.xnat_url,
                       username=args.xnat_user,
-                      password=args.xnat_pwd)
+                      password=args.xnat_pwd,
+                      tracer=tracer)
     if login.exec_() == QtWidgets.QDialog.Accepted:
         print('Successful connection to the XNAT server')
 
     xnat_project_subject = XNATSelectProjectPatient(
-        interface=login.getinterface())
+        interface=login.getinterface(),
+        mirror=mirror,
+        tracer=tracer)
     if xnat_project_subject.exec_() == QtWidgets.QDialog.Accepted:
         print('Project has been selected:' + xnat_project_subject.getproject())
         print('Subject has been selected:' + xnat_project_subject.getsubject())
@@ -513,7 +908,13 @@ if __name__ == '__main__':
         interface=login.getinterface(),
         project=xnat_project_subject.getproject(),
         subject=xnat_project_subject.getsubject(),
-        output_path=args.output_path
+        output_path=args.output_path,
+        mirror=mirror,
+        tracer=tracer
     )
     window.show()
-    sys.exit(app.exec_())
+    status = app.exec_()
+    if args.trace is not None:
+        tracer.save(args.trace)
+        tracer.printsummary()
+    sys.exit(status)
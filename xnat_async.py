@@ -0,0 +1,339 @@
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from file_stream import CHUNK_SIZE, getstream
+import functools
+import requests
+import asyncio
+import urllib3
+
+urllib3.disable_warnings()
+
+
+class AsyncXNATTransport:
+    """
+    asyncio transport for the XNAT REST endpoints used by the scripts. The
+    requests share a single connection pool and at most `concurrency` of
+    them are in flight at once, so that many small metadata calls overlap
+    instead of waiting on each other's latency.
+    """
+    def __init__(self, server, user='', password='', verify=False,
+                 concurrency=16):
+        """
+        :param server: xnat url as a string
+        :param user: xnat username, empty for anonymous access
+        :param password: xnat password
+        :param verify: check the server certificate
+        :param concurrency: maximum number of simultaneous requests
+        """
+        # Remove the last '/' to avoid requests issue
+        self.server = server.rstrip('/')
+        self.concurrency = concurrency
+        self.session = requests.session()
+        if user != '':
+            self.session.auth = (user, password)
+        self.session.verify = verify
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # requests is blocking, each call runs in one of these threads
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.loop = None
+
+    @classmethod
+    def frominterface(cls, interface, concurrency=16):
+        """
+        Create a transport using the url and credentials of a pyxnat
+        interface
+        :param interface: pyxnat interface object
+        :param concurrency: maximum number of simultaneous requests
+        :return: AsyncXNATTransport object
+        """
+        return cls(interface._server, interface._user or '',
+                   interface._pwd or '', concurrency=concurrency)
+
+    def close(self):
+        """
+        Close the connection pool and stop the worker threads
+        """
+        self.executor.shutdown()
+        self.session.close()
+
+    def semaphore(self):
+        """
+        Concurrency cap of the running event loop
+        """
+        # A semaphore belongs to one event loop and the synchronous wrapper
+        # creates a new loop for each batch
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            self.loop = loop
+            self.limit = asyncio.Semaphore(self.concurrency)
+        return self.limit
+
+    async def call(self, func, *args, **kwargs):
+        """
+        Run a blocking function in the worker threads, within the
+        concurrency cap
+        """
+        async with self.semaphore():
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self.executor, functools.partial(func, *args, **kwargs))
+
+    def url(self, uri):
+        """
+        :param uri: path starting with /data, /xapi, ... or full url
+        :return: full url
+        """
+        return uri if uri.startswith('http') else self.server + uri
+
+    async def request(self, method, uri, **kwargs):
+        """
+        Send a request to XNAT
+        :param method: http method
+        :param uri: path starting with /data, /xapi, ... or full url
+        :return: requests response object
+        """
+        return await self.call(self.session.request, method, self.url(uri),
+                               **kwargs)
+
+    async def getjson(self, uri, params=None):
+        """
+        Retrieve a json document
+        :param uri: path of the document
+        :param params: dictionary of query parameters
+        :return: decoded json document
+        """
+        params = dict(params or {})
+        params['format'] = 'json'
+        r = await self.request('GET', uri, params=params)
+        r.raise_for_status()
+        return r.json()
+
+    async def getexperiment(self, experiment_id):
+        """
+        Retrieve the full json document of an experiment, including its
+        scans
+        :param experiment_id: xnat experiment id
+        :return: dictionary of the experiment item
+        """
+        doc = await self.getjson('/data/experiments/' + experiment_id)
+        return doc['items'][0]
+
+    async def search(self, uri, params=None):
+        """
+        Query a listing endpoint, e.g. /data/projects/<id>/experiments with
+        xsiType and columns parameters
+        :param uri: path of the listing
+        :param params: dictionary of query parameters
+        :return: list of dictionaries, one per row
+        """
+        doc = await self.getjson(uri, params)
+        return doc['ResultSet']['Result']
+
+    async def listfiles(self, uri):
+        """
+        List the files of a resource, scan or experiment
+        :param uri: path of the object, e.g. .../scans/ALL or
+        .../resources/NIFTI
+        :return: list of dictionaries with the Name, Size, URI, digest, ...
+        of each file
+        """
+        return await self.search(uri + '/files')
+
+    async def exists(self, uri):
+        """
+        Check whether an object exists
+        :param uri: path of the object
+        :return: True if the object exists, False if XNAT answers 404
+        :raises requests.HTTPError: for any other error, e.g. 401 or 503, so
+        that an unreachable object is not taken for a missing one
+        """
+        r = await self.request('GET', uri, params={'format': 'json'})
+        r.close()
+        if r.status_code == 404:
+            return False
+        r.raise_for_status()
+        return True
+
+    async def download(self, uri, filename, chunk_size=1 << 20):
+        """
+        Stream a file to disk without holding it in memory
+        :param uri: path of the file
+        :param filename: local filename
+        :param chunk_size: size of the blocks written to disk
+        :return: number of bytes downloaded
+        """
+        def stream():
+            size = 0
+            with self.session.get(self.url(uri), stream=True) as r:
+                r.raise_for_status()
+                with open(filename, 'wb') as f:
+                    for chunk in r.iter_content(chunk_size):
+                        f.write(chunk)
+                        size += len(chunk)
+            return size
+        return await self.call(stream)
+
+    async def upload(self, uri, filename, params=None, chunk_size=CHUNK_SIZE,
+                     compress=False):
+        """
+        Stream a local file to XNAT, reading it in fixed-size blocks so that
+        the memory used does not depend on the file size
+        :param uri: path of the file to create
+        :param filename: local filename
+        :param params: dictionary of query parameters, e.g. format, content
+        or overwrite
+        :param chunk_size: size of the blocks read from disk in bytes
+        :param compress: gzip the file while sending it
+        :return: number of bytes sent
+        """
+        params = dict(params or {})
+        # The file is the raw request body rather than a multipart form
+        params['inbody'] = 'true'
+
+        def stream():
+            data = getstream(filename, chunk_size, compress)
+            r = self.session.put(self.url(uri), data=data, params=params)
+            r.close()
+            r.raise_for_status()
+            return data.sent
+        return await self.call(stream)
+
+    async def createresource(self, uri, params=None):
+        """
+        Create a resource if it does not exist yet
+        :param uri: path of the resource, e.g. .../scans/<id>/resources/NIFTI
+        :param params: dictionary of query parameters, e.g. format
+        :return: True if the resource was created
+        """
+        if await self.exists(uri):
+            return False
+        r = await self.request('PUT', uri, params=params)
+        r.close()
+        r.raise_for_status()
+        return True
+
+
+class XNATTransport:
+    """
+    Synchronous wrapper around AsyncXNATTransport. Each method takes a list
+    of objects and runs all their requests concurrently, so that existing
+    scripts can batch their metadata calls without becoming asynchronous.
+    """
+    def __init__(self, server, user='', password='', verify=False,
+                 concurrency=16):
+        """
+        :param server: xnat url as a string
+        :param user: xnat username, empty for anonymous access
+        :param password: xnat password
+        :param verify: check the server certificate
+        :param concurrency: maximum number of simultaneous requests
+        """
+        self.transport = AsyncXNATTransport(server, user, password, verify,
+                                            concurrency)
+
+    @classmethod
+    def frominterface(cls, interface, concurrency=16):
+        """
+        Create a transport using the url and credentials of a pyxnat
+        interface
+        :param interface: pyxnat interface object
+        :param concurrency: maximum number of simultaneous requests
+        :return: XNATTransport object
+        """
+        return cls(interface._server, interface._user or '',
+                   interface._pwd or '', concurrency=concurrency)
+
+    def close(self):
+        """
+        Close the connection pool
+        """
+        self.transport.close()
+
+    def run(self, coroutine):
+        """
+        Run a coroutine of the asynchronous transport. When an event loop is
+        already running in this thread, e.g. in a jupyter notebook, the
+        coroutine runs on a private loop in a helper thread.
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(coroutine)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(asyncio.run, coroutine).result()
+
+    def map(self, method, arguments):
+        """
+        Call an asynchronous method for each argument concurrently
+        :param method: name of an AsyncXNATTransport method
+        :param arguments: list of arguments, tuples for several arguments
+        :return: list of results, in the same order as the arguments
+        """
+        func = getattr(self.transport, method)
+
+        async def gather():
+            return await asyncio.gather(*[
+                func(*a) if isinstance(a, tuple) else func(a)
+                for a in arguments])
+        return self.run(gather())
+
+    def getjson(self, uris):
+        """
+        :param uris: list of document paths
+        :return: dictionary mapping each path to its json document
+        """
+        return dict(zip(uris, self.map('getjson', uris)))
+
+    def getexperiments(self, experiment_ids):
+        """
+        :param experiment_ids: list of xnat experiment ids
+        :return: dictionary mapping each id to its experiment item
+        """
+        return dict(zip(experiment_ids,
+                        self.map('getexperiment', experiment_ids)))
+
+    def search(self, uri, params=None):
+        """
+        :param uri: path of the listing
+        :param params: dictionary of query parameters
+        :return: list of dictionaries, one per row
+        """
+        return self.run(self.transport.search(uri, params))
+
+    def listfiles(self, uris):
+        """
+        :param uris: list of object paths
+        :return: dictionary mapping each path to its list of files
+        """
+        return dict(zip(uris, self.map('listfiles', uris)))
+
+    def exists(self, uris):
+        """
+        :param uris: list of object paths
+        :return: dictionary mapping each path to True if it exists
+        """
+        return dict(zip(uris, self.map('exists', uris)))
+
+    def download(self, files):
+        """
+        :param files: list of (uri, filename) tuples
+        :return: list of downloaded sizes
+        """
+        return self.map('download', files)
+
+    def upload(self, files):
+        """
+        :param files: list of (uri, filename, params, chunk_size, compress)
+        tuples, the last arguments being optional
+        :return: list of the numbers of bytes sent
+        """
+        return self.map('upload', files)
+
+    def createresources(self, uris):
+        """
+        :param uris: list of resource paths
+        :return: dictionary mapping each path to True if it was created
+        """
+        return dict(zip(uris, self.map('createresource', uris)))
@@ -0,0 +1,299 @@
+import argparse
+import sqlite3
+import time
+
+# Increased when the tables change, older mirrors are then recreated
+SCHEMA_VERSION = 2
+
+# Shared subjects and experiments are listed under every project they
+# belong to, so each project keeps its own rows
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS subjects (
+    project TEXT,
+    id TEXT,
+    label TEXT,
+    PRIMARY KEY (project, id)
+);
+CREATE TABLE IF NOT EXISTS experiments (
+    project TEXT,
+    id TEXT,
+    subject_id TEXT,
+    label TEXT,
+    xsi_type TEXT,
+    date TEXT,
+    scanner TEXT,
+    field_strength TEXT,
+    session_type TEXT,
+    visit_id TEXT,
+    last_modified TEXT,
+    PRIMARY KEY (project, id)
+);
+CREATE TABLE IF NOT EXISTS scans (
+    project TEXT,
+    experiment_id TEXT,
+    id TEXT,
+    type TEXT,
+    quality TEXT,
+    series_description TEXT,
+    PRIMARY KEY (project, experiment_id, id)
+);
+CREATE TABLE IF NOT EXISTS resources (
+    project TEXT,
+    experiment_id TEXT,
+    scan_id TEXT,
+    label TEXT,
+    PRIMARY KEY (project, experiment_id, scan_id, label)
+);
+CREATE TABLE IF NOT EXISTS files (
+    project TEXT,
+    uri TEXT,
+    experiment_id TEXT,
+    scan_id TEXT,
+    resource TEXT,
+    name TEXT,
+    size INTEGER,
+    digest TEXT,
+    format TEXT,
+    content TEXT,
+    PRIMARY KEY (project, uri)
+);
+CREATE TABLE IF NOT EXISTS syncs (
+    project TEXT PRIMARY KEY,
+    date TEXT
+);
+CREATE INDEX IF NOT EXISTS subjects_project ON subjects (project, label);
+CREATE INDEX IF NOT EXISTS experiments_subject ON experiments (subject_id);
+CREATE INDEX IF NOT EXISTS files_scan ON files (experiment_id, scan_id);
+"""
+
+
+def openmirror(filename):
+    """
+    Open, and create if needed, a local mirror of XNAT metadata
+    :param filename: sqlite database filename
+    :return: sqlite3 connection object
+    """
+    db = sqlite3.connect(filename)
+    db.row_factory = sqlite3.Row
+    if db.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+        # The mirror only holds copies of XNAT data, an outdated one is
+        # simply synced again
+        for table in ['subjects', 'experiments', 'scans', 'resources',
+                      'files', 'syncs']:
+            db.execute('DROP TABLE IF EXISTS ' + table)
+        db.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+    db.executescript(SCHEMA)
+    return db
+
+
+def deleteexperiments(db, project, experiment_ids):
+    """
+    Remove experiments and everything they contain from the mirror of a
+    project, the copies of shared experiments in other projects are kept
+    :param db: sqlite3 connection object
+    :param project: xnat project id
+    :param experiment_ids: list of xnat experiment ids
+    """
+    for table, column in [('experiments', 'id'),
+                          ('scans', 'experiment_id'),
+                          ('resources', 'experiment_id'),
+                          ('files', 'experiment_id')]:
+        db.executemany('DELETE FROM {} WHERE project = ? AND {} = ?'.format(
+            table, column), [(project, e) for e in experiment_ids])
+
+
+def syncproject(db, transport, project, full=False):
+    """
+    Update the mirror of a project. Only the experiments that are new or
+    whose last modification date changed are downloaded again, together
+    with their scans, resources and files.
+    :param db: sqlite3 connection object
+    :param transport: XNATTransport object
+    :param project: xnat project id
+    :param full: download all the experiments again
+    :return: dictionary with the number of experiments updated and removed
+    """
+    # The subject and experiment listings are single requests
+    subjects = transport.search('/data/projects/' + project + '/subjects',
+                                {'columns': 'ID,label'})
+    experiments = transport.search(
+        '/data/projects/' + project + '/experiments',
+        {'columns': 'ID,label,subject_ID,xsiType,date,last_modified'})
+
+    db.execute('DELETE FROM subjects WHERE project = ?', (project,))
+    db.executemany('INSERT INTO subjects VALUES (?, ?, ?)',
+                   [(project, s['ID'], s['label']) for s in subjects])
+
+    known = dict(db.execute('SELECT id, last_modified FROM experiments '
+                            'WHERE project = ?', (project,)).fetchall())
+    listed = {e['ID']: e.get('last_modified', '') for e in experiments}
+    types = {e['ID']: e.get('xsiType', '') for e in experiments}
+    removed = [e for e in known if e not in listed]
+    # Servers that do not report the modification date are always updated
+    changed = [e for e in listed
+               if full or e not in known or known[e] != listed[e] or
+               listed[e] == '']
+    deleteexperiments(db, project, removed + changed)
+
+    # Experiment documents and file listings are retrieved concurrently
+    documents = transport.getexperiments(changed)
+    file_lists = transport.listfiles(
+        ['/data/experiments/' + e + '/scans/ALL' for e in changed])
+    for e in changed:
+        fields = documents[e]['data_fields']
+        db.execute('INSERT INTO experiments VALUES '
+                   '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                   (project, e, fields.get('subject_ID'),
+                    fields.get('label'), types[e],
+                    fields.get('date'), fields.get('scanner'),
+                    fields.get('fieldStrength'), fields.get('session_type'),
+                    fields.get('visit_id'), listed[e]))
+        for c in documents[e].get('children', []):
+            if c['field'] != 'scans/scan':
+                continue
+            for s in c['items']:
+                scan = s['data_fields']
+                db.execute('INSERT INTO scans VALUES (?, ?, ?, ?, ?, ?)',
+                           (project, e, scan['ID'], scan.get('type'),
+                            scan.get('quality'),
+                            scan.get('series_description')))
+        for f in file_lists['/data/experiments/' + e + '/scans/ALL']:
+            scan_id = f['URI'].split('/scans/')[1].split('/')[0]
+            db.execute('INSERT OR IGNORE INTO resources VALUES (?, ?, ?, ?)',
+                       (project, e, scan_id, f['collection']))
+            db.execute('INSERT OR REPLACE INTO files VALUES '
+                       '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       (project, f['URI'], e, scan_id, f['collection'],
+                        f['Name'], int(f['Size'] or 0), f.get('digest', ''),
+                        f.get('file_format', ''), f.get('file_content', '')))
+    db.execute('INSERT OR REPLACE INTO syncs VALUES (?, ?)',
+               (project, time.strftime('%Y-%m-%d %H:%M:%S')))
+    db.commit()
+    return {'updated': len(changed), 'removed': len(removed)}
+
+
+def getsubjects(db):
+    """
+    Subject labels of all mirrored projects
+    :param db: sqlite3 connection object
+    :return: dictionary mapping project ids to sorted lists of subject labels
+    """
+    subject_data = dict()
+    for r in db.execute('SELECT project, label FROM subjects '
+                        'ORDER BY project, label'):
+        subject_data.setdefault(r['project'], []).append(r['label'])
+    return subject_data
+
+
+def getsessions(db, project, xsi_type='xnat:mrSessionData'):
+    """
+    Sessions of a project with their subject label
+    :param db: sqlite3 connection object
+    :param project: xnat project id
+    :param xsi_type: type of the experiments to return
+    :return: list of sqlite3 rows
+    """
+    return db.execute('SELECT e.*, s.label AS subject_label '
+                      'FROM experiments e '
+                      'LEFT JOIN subjects s ON s.project = e.project '
+                      'AND s.id = e.subject_id '
+                      'WHERE e.project = ? AND e.xsi_type = ? '
+                      'ORDER BY e.id', (project, xsi_type)).fetchall()
+
+
+def getmrsessions(db, project, subject):
+    """
+    Sessions and scans of a subject, in the structure used by the viewer
+    :param db: sqlite3 connection object
+    :param project: xnat project id
+    :param subject: xnat subject label
+    :return: dictionary mapping experiment ids to their label, date, scan
+    ids and the type and quality of each scan
+    """
+    mr_sessions = dict()
+    for e in getsessions(db, project):
+        if e['subject_label'] != subject:
+            continue
+        mr_sessions[e['id']] = {'label': e['label'],
+                                'date': e['date'],
+                                'scanIds': []}
+        for s in db.execute('SELECT * FROM scans WHERE project = ? AND '
+                            'experiment_id = ? ORDER BY rowid',
+                            (project, e['id'])):
+            if s['id'] == '99':
+                continue
+            mr_sessions[e['id']]['scanIds'].append(s['id'])
+            mr_sessions[e['id']][s['id']] = {'type': s['type'],
+                                             'quality': s['quality']}
+    return mr_sessions
+
+
+def getfiles(db, experiment_id, resource=None, project=None):
+    """
+    Files of an experiment
+    :param db: sqlite3 connection object
+    :param experiment_id: xnat experiment id
+    :param resource: only return the files of this resource label
+    :param project: xnat project id, None to use the copy of any mirrored
+    project sharing the experiment
+    :return: list of dictionaries with the URI and Name of each file, as in
+    the XNAT listing
+    """
+    query = 'SELECT * FROM files WHERE experiment_id = ?'
+    params = [experiment_id]
+    if resource is not None:
+        query += ' AND resource = ?'
+        params.append(resource)
+    if project is not None:
+        query += ' AND project = ?'
+        params.append(project)
+    else:
+        query += ' GROUP BY uri'
+    return [{'URI': f['uri'], 'Name': f['name'], 'Size': f['size'],
+             'collection': f['resource'], 'digest': f['digest'],
+             'file_content': f['content']}
+            for f in db.execute(query, params)]
+
+
+if __name__ == '__main__':
+    # Parser to set default values for xnat url and credentials
+    parser = argparse.ArgumentParser()
+    parser.add_argument('xnat_url',
+                        help='Default XNAT instance URL',
+                        type=str)
+    parser.add_argument('xnat_user',
+                        help='Default XNAT username',
+                        type=str)
+    parser.add_argument('xnat_pwd',
+                        help='Default XNAT password',
+                        type=str)
+    parser.add_argument('-p', '--project',
+                        help='XNAT project to mirror, can be repeated',
+                        type=str,
+                        action='append')
+    parser.add_argument('-d', '--database',
+                        help='Local mirror database',
+                        type=str,
+                        default='xnat_mirror.sqlite')
+    parser.add_argument('--full',
+                        help='Download all the experiments again',
+                        action='store_true')
+    parser.add_argument('-c', '--concurrency',
+                        help='Maximum number of simultaneous requests',
+                        type=int,
+                        default=16)
+    args = parser.parse_args()
+
+    from xnat_async import XNATTransport
+    transport = XNATTransport(args.xnat_url, args.xnat_user, args.xnat_pwd,
+                              concurrency=args.concurrency)
+    db = openmirror(args.database)
+    for project in args.project or ['ADNI']:
+        start = time.time()
+        result = syncproject(db, transport, project, args.full)
+        print('Project {}: {} experiment(s) updated, {} removed in '
+              '{:.1f} second(s)'.format(project, result['updated'],
+                                        result['removed'],
+                                        time.time() - start))
+    db.close()
+    transport.close()